@@ -7,33 +7,130 @@ Goal: Find out about the structure of the Anki file and convert it into a SQL co
     3. Extract the relevant structured and unstructured data 
     4. 
 '''
+import argparse
 import json
 import os
+import re
 import sqlite3
 import tempfile
 import zipfile
+import codecs
 import csv
+import glob
+import shutil
 import sys  
+import time
 import pandas as pd
 import subprocess
-from sqlalchemy import create_engine
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from sqlalchemy import create_engine, select, MetaData, Table, Column, Integer, BigInteger, String, Text, DateTime, Enum, JSON
+from sqlalchemy.dialects import mysql as mysql_dialect, sqlite as sqlite_dialect
 
 # -*- coding: utf_8 -*-
 
-def extract_db_from_apkg(apkg_path):
+# Collection members in order of preference. Newer exports ship a stub
+# collection.anki2 next to the real (zstd compressed) collection.anki21b.
+COLLECTION_MEMBERS = ['collection.anki21b', 'collection.anki21', 'collection.anki2']
+
+# Size of the buffer used when copying a zip member to disk (1 MiB).
+CHUNK_SIZE = 1024 * 1024
+
+# Number of rows fetched from SQLite per round trip.
+BATCH_SIZE = 5000
+
+# Number of rows sent per multi-row INSERT by the direct loader.
+INSERT_BATCH_SIZE = 1000
+
+# Flashcard types of the API, matched against the note model (note type) name.
+FLASHCARD_TYPES = ['kanji', 'vocab', 'radical']
+
+# The level of a note is read from tags such as "Level_05" or "Lesson 5".
+LEVEL_TAG_PATTERN = re.compile(r'(?:level|lesson)[_ -]?0*(\d+)', re.IGNORECASE)
+
+# HTML tags and the entities Anki's editor writes, removed when strip_html is set.
+HTML_TAG_PATTERN = r'<[^>]+>'
+HTML_ENTITIES = {'&nbsp;': ' ', '&lt;': '<', '&gt;': '>', '&quot;': '"', '&#39;': "'", '&amp;': '&'}
+
+# Notes in deck order: the order their first card is introduced for study (cards.due
+# of new cards), so the flashcard ids follow the deck order. Blob fields are cast to text.
+NOTES_QUERY = """
+    SELECT n.guid, n.mid, n.tags, CAST(n.flds AS TEXT) AS flds
+    FROM notes n
+    LEFT JOIN (SELECT nid, MIN(due) AS due FROM cards GROUP BY nid) c ON c.nid = n.id
+    WHERE n.mod > ?
+    ORDER BY c.due, n.id;
+"""
+
+
+def find_collection_member(myzip):
     """
-    Extracts the collection.anki2 file from the .apkg file.
+    Finds the name of the SQLite collection inside an opened .apkg file.
+
+    Args:
+        myzip (zipfile.ZipFile): The opened .apkg file.
+
+    Returns:
+        str: The name of the collection member (see COLLECTION_MEMBERS).
+    """
+    names = set(myzip.namelist())
+    for member in COLLECTION_MEMBERS:
+        if member in names:
+            return member
+    raise KeyError(f"No collection file found in the .apkg (expected one of {COLLECTION_MEMBERS})")
+
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident set size of the current process in bytes.
+
+    Returns:
+        int: The peak RSS, or 0 if it can not be measured on this platform.
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def extract_db_from_apkg(apkg_path, chunk_size=CHUNK_SIZE, verbose=False):
+    """
+    Extracts the collection database from the .apkg file.
+
+    The zip member is streamed to disk in chunks of chunk_size bytes so memory
+    use stays flat no matter how big the deck is. collection.anki21b members are
+    zstd compressed and need the optional zstandard package.
 
     Args:
         apkg_path (str): The path to the .apkg file.
+        chunk_size (int, optional): The number of bytes copied at a time.
+        verbose (bool, optional): Whether to print the size copied and the peak RSS.
 
     Returns:
         str: The name of the temporary file where the extracted data is stored.
     """
     with zipfile.ZipFile(apkg_path, 'r') as myzip:
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(myzip.read('collection.anki2'))
-            return tmp.name
+        member = find_collection_member(myzip)
+        compressed = member.endswith('.anki21b')
+        if compressed:
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError(f"{member} is zstd compressed, install the zstandard package to read it")
+        with myzip.open(member) as src, tempfile.NamedTemporaryFile(delete=False, suffix='.anki2') as tmp:
+            if compressed:
+                zstandard.ZstdDecompressor().copy_stream(src, tmp, read_size=chunk_size, write_size=chunk_size)
+            else:
+                shutil.copyfileobj(src, tmp, chunk_size)
+            size = tmp.tell()
+
+    if verbose:
+        print(f"Extracted {member} ({size / 2**20:.1f} MiB) to {tmp.name}, "
+              f"peak RSS {peak_rss_bytes() / 2**20:.1f} MiB")
+    return tmp.name
 
 
 def print_table_names(db_path, print_columns):
@@ -114,18 +211,28 @@ def replace_char_in_db(db_path, table_name, column_name, old_char, new_char):
     conn.close()
 
 
-def export_table_to_csv(db_path, output_dir, table_name, columns):
+def _decode_field(field):
+    """Decodes a bytes field and swaps the Anki field separator for a pipe."""
+    return field.decode('utf-8-sig').replace('\x1f', '|') if isinstance(field, bytes) else field
+
+
+def export_table_to_csv(db_path, output_dir, table_name, columns, batch_size=BATCH_SIZE):
     """Exports specific columns from a specific table in a SQLite database to a CSV file.
 
+    Rows are read with fetchmany and written with writerows one batch at a time,
+    so the export runs in constant memory whatever the size of the table.
+
     Args:
         db_path (str): A string representing the path to the SQLite database file.
         output_dir (str): A string representing the directory to output the CSV files.
         table_name (str): A string representing the name of the table.
         columns (list): A list of strings representing the names of the columns.
+        batch_size (int, optional): The number of rows fetched and written at a time.
 
     Returns:
-        None
+        dict: The number of rows written, the elapsed seconds and the rows per second.
     """
+    start = time.perf_counter()
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
 
@@ -134,17 +241,26 @@ def export_table_to_csv(db_path, output_dir, table_name, columns):
 
     # Get the specified columns from the specified table
     cur.execute(f"SELECT {columns_str} FROM {table_name};")
-    rows = cur.fetchall()
 
     # Create a CSV file for the table
+    row_count = 0
     with open(os.path.join(output_dir, f"{table_name}.csv"), 'w', newline='', encoding='utf-8-sig') as f:
         writer = csv.writer(f, delimiter='|')  # Use pipe as delimiter
         writer.writerow(columns)
-        for row in rows:
-            new_row = [field.decode('utf-8-sig').replace('\x1f', '|') if isinstance(field, bytes) else field for field in row]
-            writer.writerow(new_row)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.writerows([[_decode_field(field) for field in row] for row in rows])
+            row_count += len(rows)
 
     conn.close()
+    seconds = time.perf_counter() - start
+    return {
+        'rows': row_count,
+        'seconds': seconds,
+        'rows_per_sec': row_count / seconds if seconds else 0.0,
+    }
 
 
 def printfields(db_path, id):
@@ -170,38 +286,59 @@ def printfields(db_path, id):
 
 
 
-def clean_csv(input_file_path, output_file_path):
+# Invalid bytes decoded with surrogateescape become lone surrogates U+DC80..U+DCFF.
+# A run of them is dropped together with the pipes on either side.
+BAD_SEQUENCE_PATTERN = re.compile(r'(\|*)([\udc80-\udcff]+)\|*')
+# Pipes and bad bytes at the end of a chunk may continue in the next one.
+TRAILING_BAD_PATTERN = re.compile(r'[|\udc80-\udcff]*\Z')
+
+
+def clean_csv(input_file_path, output_file_path, chunk_size=CHUNK_SIZE):
     """
     Cleans a CSV file by removing problematic characters and adjacent pipes.
 
+    The file is decoded incrementally in chunks of chunk_size bytes, and every invalid
+    UTF-8 sequence (plus the pipes next to it) is dropped in the same linear pass.
+
     Args:
         input_file_path (str): The path to the input CSV file.
         output_file_path (str): The path to the output CSV file.
+        chunk_size (int, optional): The number of bytes read at a time.
 
     Returns:
-        None
+        dict: The number of 'repairs' made and the byte 'offsets' in the input file where
+        each removed invalid sequence started.
     """
-    # Open the input CSV file in binary mode and read the content
-    with open(input_file_path, 'rb') as file:
-        binary_content = file.read()
-
-    try:
-        # Try to decode the entire content with UTF-8
-        decoded_content = binary_content.decode('utf-8')
-    except UnicodeDecodeError as e:
-        # If there's a decoding error, find the position of the problematic character
-        bad_byte_index = e.start
-        # Remove the problematic character and any adjacent pipes
-        cleaned_binary_content = (binary_content[:bad_byte_index].rstrip(b'|') +
-                                  binary_content[bad_byte_index+1:].lstrip(b'|'))
-        # Attempt to decode again
-        decoded_content = cleaned_binary_content.decode('utf-8')
-
-    # Write the cleaned content to the output CSV file
-    with open(output_file_path, 'w', newline='', encoding='utf-8') as file:
-        file.write(decoded_content)
-
-
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='surrogateescape')
+    offsets = []
+    byte_pos = 0  # byte offset in the input of the first character not yet written
+    carry = ''
+
+    def write_clean(text, out):
+        nonlocal byte_pos
+        last = 0
+        for match in BAD_SEQUENCE_PATTERN.finditer(text):
+            bad_start = match.start(2)
+            byte_pos += len(text[last:bad_start].encode('utf-8', 'surrogateescape'))
+            offsets.append(byte_pos)
+            out.write(text[last:match.start()])
+            byte_pos += len(text[bad_start:match.end()].encode('utf-8', 'surrogateescape'))
+            last = match.end()
+        byte_pos += len(text[last:].encode('utf-8', 'surrogateescape'))
+        out.write(text[last:])
+
+    with open(input_file_path, 'rb') as src, open(output_file_path, 'w', newline='', encoding='utf-8') as out:
+        while True:
+            chunk = src.read(chunk_size)
+            text = carry + decoder.decode(chunk, final=not chunk)
+            if not chunk:
+                write_clean(text, out)
+                break
+            split = TRAILING_BAD_PATTERN.search(text).start()
+            carry = text[split:]
+            write_clean(text[:split], out)
+
+    return {'repairs': len(offsets), 'offsets': offsets}
 
 
 def import_csv_to_mysql(csv_file_path, mysql_db_name, table_name):
@@ -231,7 +368,7 @@ def import_csv_to_mysql(csv_file_path, mysql_db_name, table_name):
 
 def extract_apkg_to_sql(apkg_path, mysql_db_name):
     """
-    #BUG|: This function is not working as expected.
+    #BUG|: This function is not working as expected, use load_notes_to_db instead.
     Extracts the contents of an .apkg file and directly exports it to a MySQL database.
 
     Args:
@@ -264,6 +401,559 @@ def extract_apkg_to_sql(apkg_path, mysql_db_name):
     return "Data saved to MySQL database"
 
 
+def read_note_models(db_path):
+    """
+    Reads the note models (note types) of a collection.
+
+    Older collections keep them as JSON in the models column of the col table
+    (the data print_models shows), newer ones in the notetypes/fields tables.
+
+    Args:
+        db_path (str): A string representing the path to the SQLite database file.
+
+    Returns:
+        dict: Maps each model id to a dict with its 'name' and its ordered 'fields' names.
+    """
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("SELECT models FROM col;")
+    row = cur.fetchone()
+    models_json = json.loads(row[0]) if row and row[0] else {}
+
+    note_models = {}
+    for key, value in models_json.items():
+        fields = sorted(value.get('flds', []), key=lambda field: field['ord'])
+        note_models[int(key)] = {'name': value['name'], 'fields': [field['name'] for field in fields]}
+
+    if not note_models:
+        cur.execute("SELECT id, name FROM notetypes;")
+        for model_id, name in cur.fetchall():
+            note_models[model_id] = {'name': name, 'fields': []}
+        cur.execute("SELECT ntid, name FROM fields ORDER BY ntid, ord;")
+        for model_id, name in cur.fetchall():
+            note_models[model_id]['fields'].append(name)
+
+    conn.close()
+    return note_models
+
+
+def flashcard_type_for_model(model_name):
+    """
+    Maps a note model name to one of the FLASHCARD_TYPES.
+
+    Args:
+        model_name (str): The name of the note model, e.g. "WaniKani Vocab".
+
+    Returns:
+        str: The flashcard type, or None if the model is not a known type.
+    """
+    lowered = model_name.lower()
+    for flashcard_type in FLASHCARD_TYPES:
+        if flashcard_type in lowered:
+            return flashcard_type
+    return None
+
+
+def levels_from_tags(tags):
+    """
+    Reads the level number of each note from its space separated tags.
+
+    Args:
+        tags (pandas.Series): The tags column of the notes.
+
+    Returns:
+        pandas.Series: The levels as integers, 0 where no tag carries one.
+    """
+    levels = tags.fillna('').str.extract(LEVEL_TAG_PATTERN.pattern, flags=re.IGNORECASE, expand=False)
+    return pd.to_numeric(levels).fillna(0).astype(int)
+
+
+def flashcards_table(metadata, table_name='flashcards'):
+    """
+    Describes the flashcards table of the FastAPI app (see my-fastapi-app/app/models.py).
+
+    Args:
+        metadata (sqlalchemy.MetaData): The metadata the table is bound to.
+        table_name (str, optional): The name of the table.
+
+    Returns:
+        sqlalchemy.Table: The table.
+    """
+    return Table(
+        table_name, metadata,
+        Column('id', Integer, primary_key=True, index=True),
+        Column('guid', String(64), unique=True, index=True),
+        Column('level', Integer, index=True),
+        Column('type', Enum(*FLASHCARD_TYPES, name='flashcardtype'), index=True),
+        Column('fields', Text),
+        Column('field_values', JSON),
+    )
+
+
+def import_state_table(metadata):
+    """
+    Describes the table recording the newest note mod/usn imported from each deck.
+
+    Args:
+        metadata (sqlalchemy.MetaData): The metadata the table is bound to.
+
+    Returns:
+        sqlalchemy.Table: The table.
+    """
+    return Table(
+        'import_state', metadata,
+        Column('deck', String(255), primary_key=True),
+        Column('last_mod', BigInteger),
+        Column('last_usn', Integer),
+        Column('imported_at', DateTime),
+    )
+
+
+def catalog_version_table(metadata):
+    """
+    Describes the table holding the catalog version stamp of the API (see my-fastapi-app/app/cache.py).
+
+    Args:
+        metadata (sqlalchemy.MetaData): The metadata the table is bound to.
+
+    Returns:
+        sqlalchemy.Table: The table.
+    """
+    return Table(
+        'catalog_version', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('version', Integer, nullable=False, default=0),
+    )
+
+
+def bump_catalog_version(conn, version_table):
+    """
+    Increments the catalog version so the API drops its cached flashcards.
+    """
+    result = conn.execute(version_table.update().where(version_table.c.id == 1).values(version=version_table.c.version + 1))
+    if result.rowcount == 0:
+        conn.execute(version_table.insert().values(id=1, version=1))
+
+
+def upsert_statement(table, rows, dialect_name):
+    """
+    Builds a multi-row INSERT that updates the existing row when the note guid is already there.
+
+    Args:
+        table (sqlalchemy.Table): The flashcards table.
+        rows (list[dict]): The rows to write.
+        dialect_name (str): The name of the database dialect ('mysql' or 'sqlite').
+
+    Returns:
+        The INSERT statement.
+    """
+    if dialect_name == 'mysql':
+        stmt = mysql_dialect.insert(table).values(rows)
+        return stmt.on_duplicate_key_update({name: stmt.inserted[name] for name in rows[0] if name != 'guid'})
+    if dialect_name == 'sqlite':
+        stmt = sqlite_dialect.insert(table).values(rows)
+        return stmt.on_conflict_do_update(index_elements=['guid'], set_={name: stmt.excluded[name] for name in rows[0] if name != 'guid'})
+    raise ValueError(f"Upserting is not supported for the {dialect_name} dialect")
+
+
+def read_note_watermark(db_path):
+    """
+    Reads the newest modification time and update sequence number of the notes in a collection.
+
+    Args:
+        db_path (str): A string representing the path to the SQLite database file.
+
+    Returns:
+        tuple: The largest notes.mod and notes.usn (both 0 for an empty collection).
+    """
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("SELECT COALESCE(MAX(mod), 0), COALESCE(MAX(usn), 0) FROM notes;")
+    watermark = cur.fetchone()
+    conn.close()
+    return watermark
+
+
+def read_import_state(conn, state_table, deck):
+    """
+    Returns the last_mod recorded for a deck, or None if it was never imported.
+    """
+    return conn.execute(select(state_table.c.last_mod).where(state_table.c.deck == deck)).scalar()
+
+
+def write_import_state(conn, state_table, deck, last_mod, last_usn):
+    """
+    Records the newest note mod/usn imported from a deck.
+    """
+    conn.execute(state_table.delete().where(state_table.c.deck == deck))
+    conn.execute(state_table.insert().values(deck=deck, last_mod=last_mod, last_usn=last_usn, imported_at=datetime.now()))
+
+
+def read_note_frames(db_path, batch_size=BATCH_SIZE, since_mod=None):
+    """
+    Reads the notes of a collection (guid, mid, tags, flds) in deck order as DataFrames.
+
+    Args:
+        db_path (str): A string representing the path to the SQLite database file.
+        batch_size (int, optional): The number of notes per DataFrame.
+        since_mod (int, optional): Only read the notes modified after this time (notes.mod).
+
+    Yields:
+        pandas.DataFrame: The next batch_size notes.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        yield from pd.read_sql_query(NOTES_QUERY, conn, params=(since_mod if since_mod is not None else -1,), chunksize=batch_size)
+    finally:
+        conn.close()
+
+
+def transform_notes(notes, note_models, strip_html=False):
+    """
+    Turns a DataFrame of notes into flashcards table rows with column-wise string operations.
+
+    Args:
+        notes (pandas.DataFrame): Notes as read by read_note_frames.
+        note_models (dict): The note models as returned by read_note_models.
+        strip_html (bool, optional): Whether to remove HTML tags and entities from the fields.
+
+    Returns:
+        pandas.DataFrame: The guid, level, type, fields and field_values columns, without
+        the notes whose model is not one of the FLASHCARD_TYPES. field_values maps the
+        field names of the note model (e.g. "Meaning", "Reading") to their values.
+    """
+    model_types = {model_id: flashcard_type_for_model(model['name']) for model_id, model in note_models.items()}
+    notes = notes.assign(type=notes['mid'].map(model_types)).dropna(subset=['type'])
+
+    flds = notes['flds'].fillna('').astype(str).str.removeprefix('\ufeff')
+    if strip_html:
+        flds = flds.str.replace(HTML_TAG_PATTERN, '', regex=True)
+        for entity, char in HTML_ENTITIES.items():
+            flds = flds.str.replace(entity, char, regex=False)
+
+    field_values = []
+    for mid, group in flds.groupby(notes['mid']):
+        names = note_models[mid]['fields']
+        values = group.str.split('\x1f', regex=False)
+        field_values.append(pd.Series([dict(zip(names, parts)) for parts in values], index=values.index, dtype=object))
+
+    return pd.DataFrame({
+        'guid': notes['guid'],
+        'level': levels_from_tags(notes['tags']),
+        'type': notes['type'],
+        'fields': flds.str.replace('\x1f', '|', regex=False),
+        'field_values': pd.concat(field_values) if field_values else pd.Series(dtype=object),
+    }, index=notes.index)
+
+
+def iter_note_rows(db_path, batch_size=BATCH_SIZE, since_mod=None, strip_html=False):
+    """
+    Reads the notes of a collection as flashcards table rows, one batch at a time.
+
+    Args:
+        db_path (str): A string representing the path to the SQLite database file.
+        batch_size (int, optional): The number of notes fetched at a time.
+        since_mod (int, optional): Only read the notes modified after this time (notes.mod).
+        strip_html (bool, optional): Whether to remove HTML tags and entities from the fields.
+
+    Yields:
+        tuple: A list of row dicts (see transform_notes) and the number of notes skipped
+        because their model is not one of the FLASHCARD_TYPES.
+    """
+    note_models = read_note_models(db_path)
+    for notes in read_note_frames(db_path, batch_size, since_mod):
+        flashcards = transform_notes(notes, note_models, strip_html)
+        yield flashcards.to_dict('records'), len(notes) - len(flashcards)
+
+
+def load_notes_to_db(db_path, db_url, table_name='flashcards', batch_size=INSERT_BATCH_SIZE, deck=None, strip_html=False):
+    """
+    Loads the notes of a collection straight into the flashcards table of the API database.
+
+    This replaces the export_table_to_csv -> clean_csv -> import_csv_to_mysql round trip:
+    the notes are read once and written with multi-row INSERTs of batch_size rows, all in
+    one transaction, so a failed import leaves the table untouched. Rows are keyed on the
+    Anki note guid, so importing a deck again updates its flashcards instead of duplicating them.
+
+    Args:
+        db_path (str): A string representing the path to the SQLite database file.
+        db_url (str): The SQLAlchemy URL of the target database, e.g.
+            'mysql+pymysql://root:@localhost/FlashcardDB' or 'sqlite:///flashcards.db'.
+        table_name (str, optional): The name of the target table, created if it does not exist.
+        batch_size (int, optional): The number of rows per INSERT statement.
+        deck (str, optional): A name for the deck. When given the import is incremental: only
+            the notes modified since the last import of this deck are read and written.
+        strip_html (bool, optional): Whether to remove HTML tags and entities from the fields.
+
+    Returns:
+        dict: The number of rows written and skipped, the elapsed seconds and the rows per second.
+    """
+    start = time.perf_counter()
+    engine = create_engine(db_url)
+    metadata = MetaData()
+    table = flashcards_table(metadata, table_name)
+    state_table = import_state_table(metadata)
+    version_table = catalog_version_table(metadata)
+    metadata.create_all(engine)
+
+    inserted = skipped = 0
+    with engine.begin() as conn:
+        since_mod = read_import_state(conn, state_table, deck) if deck else None
+        for rows, skipped_notes in iter_note_rows(db_path, batch_size, since_mod, strip_html):
+            if rows:
+                conn.execute(upsert_statement(table, rows, engine.dialect.name))
+            inserted += len(rows)
+            skipped += skipped_notes
+        if deck:
+            write_import_state(conn, state_table, deck, *read_note_watermark(db_path))
+        if inserted:
+            bump_catalog_version(conn, version_table)
+    engine.dispose()
+
+    seconds = time.perf_counter() - start
+    return {
+        'rows': inserted,
+        'skipped': skipped,
+        'seconds': seconds,
+        'rows_per_sec': inserted / seconds if seconds else 0.0,
+    }
+
+
+def prepare_deck(apkg_path, batch_size=INSERT_BATCH_SIZE, since_mod=None, strip_html=False):
+    """
+    Extracts a deck and turns its notes into flashcards table rows.
+
+    This is the part of an import that needs no database connection, so
+    import_decks runs it for many decks at once in worker processes.
+
+    Args:
+        apkg_path (str): The path to the .apkg file.
+        batch_size (int, optional): The number of rows per batch.
+        since_mod (int, optional): Only read the notes modified after this time (notes.mod).
+        strip_html (bool, optional): Whether to remove HTML tags and entities from the fields.
+
+    Returns:
+        dict: The 'deck' path, the row 'batches', the number of notes 'skipped',
+        the notes 'watermark' (see read_note_watermark) and the 'seconds' spent.
+    """
+    start = time.perf_counter()
+    db_path = extract_db_from_apkg(apkg_path)
+    try:
+        batches = []
+        skipped = 0
+        for rows, skipped_notes in iter_note_rows(db_path, batch_size, since_mod, strip_html):
+            if rows:
+                batches.append(rows)
+            skipped += skipped_notes
+        watermark = read_note_watermark(db_path)
+    finally:
+        os.remove(db_path)
+    return {'deck': apkg_path, 'batches': batches, 'skipped': skipped, 'watermark': watermark,
+            'seconds': time.perf_counter() - start}
+
+
+def expand_deck_paths(patterns):
+    """
+    Expands directories and glob patterns into a sorted list of .apkg files.
+
+    Args:
+        patterns (list[str]): Deck files, directories containing decks or glob patterns.
+
+    Returns:
+        list[str]: The deck paths, without duplicates.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(glob.glob(os.path.join(pattern, '*.apkg')))
+        else:
+            paths.update(glob.glob(pattern))
+    return sorted(paths)
+
+
+def import_decks(apkg_paths, db_url, table_name='flashcards', batch_size=INSERT_BATCH_SIZE, workers=None, incremental=False, strip_html=False):
+    """
+    Imports many decks into the flashcards table of the API database.
+
+    Extracting and parsing run in a process pool while this process is the single
+    writer: each deck is inserted in its own transaction as soon as it is ready, so
+    a bad deck is reported and skipped without aborting the rest of the batch.
+    In incremental mode only the notes modified since the last import of each deck
+    (keyed on the deck file name) are read, so an unchanged deck is close to a no-op.
+
+    Args:
+        apkg_paths (list[str]): The paths to the .apkg files.
+        db_url (str): The SQLAlchemy URL of the target database.
+        table_name (str, optional): The name of the target table, created if it does not exist.
+        batch_size (int, optional): The number of rows per INSERT statement.
+        workers (int, optional): The number of worker processes, defaults to the CPU count.
+        incremental (bool, optional): Whether to skip the notes imported by a previous run.
+        strip_html (bool, optional): Whether to remove HTML tags and entities from the fields.
+
+    Returns:
+        list[dict]: One summary per deck with its 'deck', 'rows', 'skipped', 'seconds',
+        'rows_per_sec' and 'error' (None if the import succeeded).
+    """
+    engine = create_engine(db_url)
+    metadata = MetaData()
+    table = flashcards_table(metadata, table_name)
+    state_table = import_state_table(metadata)
+    version_table = catalog_version_table(metadata)
+    metadata.create_all(engine)
+
+    since_mods = {}
+    if incremental:
+        with engine.connect() as conn:
+            since_mods = {path: read_import_state(conn, state_table, os.path.basename(path)) for path in apkg_paths}
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(prepare_deck, path, batch_size, since_mods.get(path), strip_html): path for path in apkg_paths}
+        total = len(futures)
+        for done, future in enumerate(as_completed(futures), start=1):
+            # Forget the future once handled, so its row batches can be freed before the next deck
+            summary = {'deck': futures.pop(future), 'rows': 0, 'skipped': 0, 'seconds': 0.0, 'rows_per_sec': 0.0, 'error': None}
+            try:
+                prepared = future.result()
+                write_start = time.perf_counter()
+                with engine.begin() as conn:
+                    for rows in prepared['batches']:
+                        conn.execute(upsert_statement(table, rows, engine.dialect.name))
+                    write_import_state(conn, state_table, os.path.basename(prepared['deck']), *prepared['watermark'])
+                    if prepared['batches']:
+                        bump_catalog_version(conn, version_table)
+                summary['rows'] = sum(len(rows) for rows in prepared['batches'])
+                summary['skipped'] = prepared['skipped']
+                summary['seconds'] = prepared['seconds'] + time.perf_counter() - write_start
+                summary['rows_per_sec'] = summary['rows'] / summary['seconds'] if summary['seconds'] else 0.0
+                print(f"[{done}/{total}] {os.path.basename(summary['deck'])}: {summary['rows']} flashcards "
+                      f"in {summary['seconds']:.2f}s ({summary['rows_per_sec']:.0f} rows/s)")
+            except Exception as e:
+                summary['error'] = f"{type(e).__name__}: {e}"
+                print(f"[{done}/{total}] {os.path.basename(summary['deck'])}: FAILED ({summary['error']})")
+            summaries.append(summary)
+            # Drop the deck's rows before waiting for the next one
+            prepared = future = None
+    engine.dispose()
+    return summaries
+
+
+def print_import_summary(summaries):
+    """
+    Prints the throughput of each deck of an import_decks run and the totals.
+
+    Args:
+        summaries (list[dict]): The summaries returned by import_decks.
+
+    Returns:
+        None
+    """
+    print(f"{'Deck':<40} {'Rows':>8} {'Skipped':>8} {'Seconds':>8} {'Rows/s':>10}")
+    for summary in sorted(summaries, key=lambda summary: summary['deck']):
+        name = os.path.basename(summary['deck'])
+        if summary['error']:
+            print(f"{name:<40} FAILED: {summary['error']}")
+        else:
+            print(f"{name:<40} {summary['rows']:>8} {summary['skipped']:>8} {summary['seconds']:>8.2f} {summary['rows_per_sec']:>10.0f}")
+    failed = sum(1 for summary in summaries if summary['error'])
+    print(f"{len(summaries) - failed} decks imported, {failed} failed, "
+          f"{sum(summary['rows'] for summary in summaries)} flashcards in total")
+
+
+def cli(argv=None):
+    """Command line entry point to import one or more decks into the API database."""
+    parser = argparse.ArgumentParser(description="Import Anki decks into the flashcards table.")
+    parser.add_argument('decks', nargs='+', help="deck files, directories of decks or glob patterns")
+    parser.add_argument('--db-url', default='mysql+pymysql://root:@localhost/FlashcardDB', help="SQLAlchemy URL of the target database")
+    parser.add_argument('--table', default='flashcards', help="name of the target table")
+    parser.add_argument('--batch-size', type=int, default=INSERT_BATCH_SIZE, help="rows per INSERT statement")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument('--incremental', action='store_true', help="only import the notes changed since the last import of each deck")
+    parser.add_argument('--strip-html', action='store_true', help="remove HTML tags and entities from the note fields")
+    args = parser.parse_args(argv)
+
+    apkg_paths = expand_deck_paths(args.decks)
+    if not apkg_paths:
+        parser.error("no .apkg files found")
+    summaries = import_decks(apkg_paths, args.db_url, args.table, args.batch_size, args.workers, args.incremental, args.strip_html)
+    print_import_summary(summaries)
+    return 1 if any(summary['error'] for summary in summaries) else 0
+
+
+def make_synthetic_collection(db_path, n_notes):
+    """
+    Writes a minimal collection with n_notes WaniKani-like notes, for benchmarks.
+
+    Args:
+        db_path (str): The path of the SQLite database file to create.
+        n_notes (int): The number of notes (and cards) to generate.
+
+    Returns:
+        None
+    """
+    models = {
+        str(model_id): {'name': name, 'flds': [{'name': field, 'ord': ord} for ord, field in enumerate([kind, 'Meaning', 'Reading'])]}
+        for model_id, name, kind in [(1, 'WaniKani Radical', 'Radical'), (2, 'WaniKani Kanji', 'Kanji'), (3, 'WaniKani Vocab', 'Vocab')]
+    }
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE col (id INTEGER PRIMARY KEY, models TEXT);")
+    cur.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, guid TEXT, mid INTEGER, mod INTEGER, usn INTEGER, tags TEXT, flds TEXT);")
+    cur.execute("CREATE TABLE cards (id INTEGER PRIMARY KEY, nid INTEGER, due INTEGER);")
+    cur.execute("INSERT INTO col VALUES (1, ?);", (json.dumps(models),))
+    cur.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?);", (
+        (i, f'guid{i}', i % 3 + 1, i, -1, f' Level_{i % 60 + 1:02d} ',
+         f'<b>字{i}</b>\x1fmeaning&nbsp;{i}\x1f<span class="reading">よみ{i}</span>')
+        for i in range(n_notes)))
+    cur.executemany("INSERT INTO cards VALUES (?, ?, ?);", ((i, i, i) for i in range(n_notes)))
+    conn.commit()
+    conn.close()
+
+
+def benchmark_transform(n_notes=100_000):
+    """
+    Times transform_notes against the same transform done one row at a time in Python
+    (the loop iter_note_rows used to run) on a synthetic collection and prints the results.
+
+    Args:
+        n_notes (int, optional): The number of notes in the synthetic collection.
+
+    Returns:
+        dict: The seconds taken by the 'loop' and the 'vectorized' transform.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'collection.anki2')
+        make_synthetic_collection(db_path, n_notes)
+        note_models = read_note_models(db_path)
+        frames = list(read_note_frames(db_path))
+
+    model_types = {model_id: flashcard_type_for_model(model['name']) for model_id, model in note_models.items()}
+    html_tag = re.compile(HTML_TAG_PATTERN)
+    start = time.perf_counter()
+    for notes in frames:
+        rows = []
+        for guid, mid, tags, flds in notes.itertuples(index=False):
+            if model_types.get(mid) is None:
+                continue
+            flds = html_tag.sub('', flds)
+            for entity, char in HTML_ENTITIES.items():
+                flds = flds.replace(entity, char)
+            match = LEVEL_TAG_PATTERN.search(tags or '')
+            values = flds.split('\x1f')
+            rows.append({'guid': guid, 'level': int(match.group(1)) if match else 0, 'type': model_types[mid],
+                         'fields': '|'.join(values), 'field_values': dict(zip(note_models[mid]['fields'], values))})
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for notes in frames:
+        transform_notes(notes, note_models, strip_html=True)
+    vectorized_seconds = time.perf_counter() - start
+
+    print(f"{n_notes} notes: loop {loop_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s "
+          f"({loop_seconds / vectorized_seconds:.1f}x)")
+    return {'loop': loop_seconds, 'vectorized': vectorized_seconds}
+
+
 def main():
     """Main function to run the script."""
     
@@ -271,7 +961,7 @@ def main():
     # local variables
     apkg_path = '/Users/air/Desktop/delete/WaniKani_Complete_Lv_1-60.apkg'
     mysql_db_name = 'FlashcardDB'  # name MySQL database
-    db_path = extract_db_from_apkg(apkg_path)
+    db_path = extract_db_from_apkg(apkg_path, verbose=True)
     
     """Data Exploration/Analysis"""
     #print_table_names(db_path, print_columns=True)
@@ -279,28 +969,23 @@ def main():
     #print_models(db_path, ids)
     #export_tables_to_csv(db_path, '/Users/air/Desktop/delete')
     #printfields(db_path,1413122652443 )
+    #benchmark_transform(100_000)
+
+    """Exporting to CSV (superseded by load_notes_to_db below)"""
+    #replace_char_in_db(db_path, 'notes', 'flds', '\x1f', '|')
+    #output_dir = '/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv'
+    #export_stats = export_table_to_csv(db_path, output_dir, 'notes', ['flds'])
+    #clean_report = clean_csv('/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv/Import.csv', '/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv/ImportClean.csv')
+    #import_csv_to_mysql('/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv/ImportA.csv', 'Cards', 'flashcards')
+
+    """Loading the notes straight into the flashcards table"""
+    load_stats = load_notes_to_db(db_path, f'mysql+pymysql://root:@localhost/{mysql_db_name}', deck=os.path.basename(apkg_path))
+    print(f"Loaded {load_stats['rows']} flashcards ({load_stats['skipped']} notes skipped) "
+          f"in {load_stats['seconds']:.2f}s ({load_stats['rows_per_sec']:.0f} rows/s)")
 
-    """Data Cleaning."""
-    replace_char_in_db(db_path, 'notes', 'flds', '\x1f', '|')
-    
-    """Exporting"""
-    output_dir = '/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv'
-    table_name = 'notes'
-    columns = ['flds']
-    
-    # Export the notes table to a CSV file
-    export_table_to_csv(db_path, output_dir, table_name, columns) 
-    # Clean the exported CSV file 
-    clean_csv('/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv/Import.csv', '/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv/ImportClean.csv')  
-    # Import the cleaned CSV file into a MySQL database
-    import_csv_to_mysql('/Users/air/Desktop/delete/WaniKaniCSV/trimmed csv/ImportA.csv', 'Cards', 'flashcards')
-    
-    
-    """(NOT Working)Export the .apkg file to a MySQL database"""
-    #mysql_db_name = 'FlashcardDB'  # replace with the name of your MySQL database
-    #extract_apkg_to_sql(apkg_path, mysql_db_name)
-    
     os.remove(db_path) # remove the temporary file
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(cli())
     main()
@@ -1,16 +1,20 @@
 from datetime import timedelta, datetime, timezone
-from typing import Annotated
+from hashlib import sha256
+from typing import Annotated, Optional
 from fastapi import APIRouter, Depends, HTTPException 
 from pydantic import BaseModel 
+from sqlalchemy import select
 from sqlalchemy.orm import Session 
 from starlette import status 
 from dotenv import load_dotenv
-from passlib.context import CryptContext 
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from jose import jwt, JWTError
 import os
+import time
 
-from db import get_db
+from cache import LRUCache
+from db import get_db, get_async_db, execute, commit
+from passwords import bcrypt_context, password_hasher
 from models import User 
 from schemas import UserBase, FlashcardType, FlashcardBase, CreateUserRequest, Token
 #from router import auth_router, main_router
@@ -27,10 +31,92 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 ALGORITHM = os.getenv('ALGORITHM')
 
 
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto') # bcrypt hashing algorithm
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token') # OAuth2 password bearer
 
 
+# Both caches are only used from async code on the event loop, so they need no lock.
+class TokenCache:
+    """Claims of verified tokens by the SHA-256 of the token, LRU bounded; each entry is dropped at its exp."""
+
+    def __init__(self, maxsize: int = 10_000):
+        self.claims = LRUCache(maxsize)
+        self.expired = 0
+
+    def get(self, key: bytes) -> Optional[dict]:
+        entry = self.claims.get(key)
+        if entry is None:
+            return None
+        claims, expires = entry
+        if time.time() >= expires:
+            # jwt.decode will now reject the token
+            self.claims.pop(key)
+            self.expired += 1
+            return None
+        return claims
+
+    def put(self, key: bytes, claims: dict, expires: float):
+        self.claims.put(key, (claims, expires))
+
+    def stats(self) -> dict:
+        return {**self.claims.stats(), "expired": self.expired}
+
+
+class UserCache:
+    """Snapshots of user rows by id, and user ids by username, both LRU bounded.
+
+    Entries are reloaded after `ttl` seconds, so a password or email changed by another
+    process is picked up; a failed password check also drops the user's entry.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 300.0):
+        self.by_id = LRUCache(maxsize)
+        self.ids = LRUCache(maxsize)
+        self.ttl = ttl
+
+    def _fresh(self, user_id) -> Optional[UserBase]:
+        entry = self.by_id.get(user_id)
+        if entry is None:
+            return None
+        loaded, user = entry
+        if time.monotonic() - loaded >= self.ttl:
+            self.by_id.pop(user_id)
+            return None
+        return user
+
+    def _put(self, row: User) -> UserBase:
+        user = UserBase(id=row.id, username=row.username, password=row.password, email=row.email, created_at=row.created_at)
+        self.by_id.put(user.id, (time.monotonic(), user))
+        self.ids.put(user.username, user.id)
+        return user
+
+    async def get(self, db, user_id: int) -> Optional[UserBase]:
+        user = self._fresh(user_id)
+        if user is None:
+            row = (await execute(db, select(User).filter(User.id == user_id))).scalars().first()
+            user = self._put(row) if row else None
+        return user
+
+    async def get_by_username(self, db, username: str) -> Optional[UserBase]:
+        user_id = self.ids.get(username)
+        user = self._fresh(user_id) if user_id is not None else None
+        if user is None or user.username != username:
+            row = (await execute(db, select(User).filter(User.username == username))).scalars().first()
+            user = self._put(row) if row else None
+        return user
+
+    def invalidate(self, user_id: int):
+        user = self.by_id.pop(user_id)
+        if user is not None:
+            self.ids.pop(user[1].username)
+
+    def stats(self) -> dict:
+        return {"by_id": self.by_id.stats(), "by_username": self.ids.stats()}
+
+
+token_cache = TokenCache()
+user_cache = UserCache()
+
+
 '''
 db_dependency = Annotated[Session, Depends(get_db)]                       
 #user_dependency = Annotated [dict, Depends (get_current_user)]
@@ -67,11 +153,12 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
     access_token = create_access_token(user.username, user.id, timedelta(minutes=20))
     return {"access_token": access_token, "token_type": "bearer"}
 '''
-def authenticate_user(username: str, password: str, db):
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(username: str, password: str, db):
+    user = await user_cache.get_by_username(db, username)
     if not user:
         return False
-    if not bcrypt_context.verify(password, user.password):
+    if not await password_hasher.verify(password, user.password):
+        user_cache.invalidate(user.id)
         return False
     return user
 
@@ -84,22 +171,37 @@ def create_access_token(username: str, user_id: int, expires_delta: timedelta):
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
 async def get_current_user(token: Annotated [str, Depends (oauth2_bearer)]):
+    # A token verified before is looked up instead of checking its signature again
+    key = sha256(token.encode()).digest()
+    claims = token_cache.get(key)
+    if claims is not None:
+        return dict(claims)
     try:
         payload = jwt.decode (token, SECRET_KEY, algorithms=[ALGORITHM] )
         username: str = payload.get('sub')
         user_id: int = payload.get('id')
         if username is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
-        return {'username': username, 'id': user_id}
+        claims = {'username': username, 'id': user_id}
+        if payload.get('exp') is not None:
+            token_cache.put(key, claims, payload['exp'])
+        return dict(claims)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
 
+async def get_current_user_record(current_user: Annotated[dict, Depends(get_current_user)], db = Depends(get_async_db)) -> UserBase:
+    """The user row of the token's user (a cached snapshot), for routes that need more than the claims."""
+    user = await user_cache.get(db, current_user['id'])
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate user.')
+    return user
+
 
 ## functions for creating user and token
 async def create_user(db: get_db, create_user_request: CreateUserRequest):
-    existing_user = db.query(User).filter(
+    existing_user = (await execute(db, select(User).filter(
         (User.username == create_user_request.username) | (User.email == create_user_request.email)
-    ).first()
+    ))).scalars().first()
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -107,16 +209,16 @@ async def create_user(db: get_db, create_user_request: CreateUserRequest):
         )
     create_user_model = User(
         username=create_user_request.username,
-        password=bcrypt_context.hash(create_user_request.password),
+        password=await password_hasher.hash(create_user_request.password),
         email=create_user_request.email,
         created_at=datetime.now(),
     )
     db.add(create_user_model)
-    db.commit()
+    await commit(db)
     return {"message": "User created successfully"}
 
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: get_db):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,230 @@
+"""
+FSRS over whole decks with NumPy.
+
+The fsrs package schedules one Card at a time. BatchFSRS applies the same formulas (fsrs 3.x,
+FSRS-5 weights) to every card of a deck at once: the CardSchedule rows are loaded into one
+array per column, updated with array arithmetic and written back with one bulk UPDATE.
+`review` matches FSRS.repeat(card, now)[rating].card for each card and `reschedule`
+recomputes the intervals and due dates of reviewed cards, e.g. after the weights or the
+requested retention changed. bench.py fsrs_batch checks both against the fsrs package.
+"""
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import numpy as np
+from fsrs import FSRS, Rating, State
+from sqlalchemy.orm import Session
+
+import models
+from scheduler import SCHEDULE_FIELDS, parse_state
+
+
+AGAIN, HARD, GOOD, EASY = (rating.value for rating in Rating)
+NEW, LEARNING, REVIEW, RELEARNING = (state.value for state in State)
+STATE_NAMES = np.array([state.name for state in sorted(State, key=lambda state: state.value)], dtype=object)
+
+MINUTE = np.timedelta64(60_000_000, "us")
+DAY = np.timedelta64(86_400_000_000, "us")
+
+
+def to_datetime64(values) -> np.ndarray:
+    """Naive UTC datetimes (None for missing) as a datetime64[us] array with NaT for None."""
+    return np.array([np.datetime64(value, "us") if value is not None else np.datetime64("NaT") for value in values], dtype="datetime64[us]")
+
+
+def from_datetime64(values: np.ndarray) -> list:
+    """The inverse of to_datetime64: naive datetimes, None for NaT."""
+    return [None if value is None else value for value in values.astype("datetime64[us]").tolist()]
+
+
+def load_schedules(db: Session, user_id: int) -> Dict[str, np.ndarray]:
+    """Reads every CardSchedule row of a user into one array per column (plus "id"), in id order."""
+    columns = [getattr(models.CardSchedule, name) for name in ("id",) + SCHEDULE_FIELDS]
+    rows = db.query(*columns).filter(models.CardSchedule.user_id == user_id).order_by(models.CardSchedule.id).all()
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    deck = dict(zip(("id",) + SCHEDULE_FIELDS, values))
+    states = {value: parse_state(value).value for value in set(deck["state"])}
+    return {
+        "id": np.array(deck["id"], dtype=np.int64),
+        "due": to_datetime64(deck["due"]),
+        "stability": np.array(deck["stability"], dtype=np.float64),
+        "difficulty": np.array(deck["difficulty"], dtype=np.float64),
+        "elapsed_days": np.array(deck["elapsed_days"], dtype=np.int64),
+        "scheduled_days": np.array(deck["scheduled_days"], dtype=np.int64),
+        "reps": np.array(deck["reps"], dtype=np.int64),
+        "lapses": np.array(deck["lapses"], dtype=np.int64),
+        "state": np.array([states[value] for value in deck["state"]], dtype=np.int8),
+        "last_review": to_datetime64(deck["last_review"]),
+    }
+
+
+def save_schedules(db: Session, deck: Dict[str, np.ndarray]):
+    """Writes the arrays of a deck back to CardSchedule with one bulk UPDATE (the caller commits)."""
+    columns = {
+        "id": deck["id"].tolist(),
+        "due": from_datetime64(deck["due"]),
+        "stability": deck["stability"].tolist(),
+        "difficulty": deck["difficulty"].tolist(),
+        "elapsed_days": deck["elapsed_days"].tolist(),
+        "scheduled_days": deck["scheduled_days"].tolist(),
+        "reps": deck["reps"].tolist(),
+        "lapses": deck["lapses"].tolist(),
+        "state": STATE_NAMES[deck["state"]].tolist(),
+        "last_review": from_datetime64(deck["last_review"]),
+    }
+    names = list(columns)
+    db.bulk_update_mappings(models.CardSchedule, [dict(zip(names, values)) for values in zip(*columns.values())])
+
+
+class BatchFSRS:
+    """The formulas of an fsrs.FSRS scheduler, over arrays of cards."""
+
+    def __init__(self, scheduler: Optional[FSRS] = None):
+        scheduler = scheduler or FSRS()
+        self.w = np.asarray(scheduler.p.w, dtype=np.float64)
+        self.request_retention = scheduler.p.request_retention
+        self.maximum_interval = scheduler.p.maximum_interval
+        self.DECAY = scheduler.DECAY
+        self.FACTOR = scheduler.FACTOR
+
+    def init_stability(self, rating):
+        return np.maximum(self.w[rating - 1], 0.1)
+
+    def init_difficulty(self, rating):
+        return np.clip(self.w[4] - np.exp(self.w[5] * (rating - 1)) + 1, 1, 10)
+
+    def forgetting_curve(self, elapsed_days, stability):
+        return (1 + self.FACTOR * elapsed_days / stability) ** self.DECAY
+
+    def next_interval(self, stability) -> np.ndarray:
+        interval = stability / self.FACTOR * (self.request_retention ** (1 / self.DECAY) - 1)
+        # np.rint rounds halves to even, like round() in fsrs
+        return np.clip(np.rint(interval), 1, self.maximum_interval).astype(np.int64)
+
+    def next_difficulty(self, difficulty, rating):
+        next_d = difficulty - self.w[6] * (rating - 3)
+        reverted = self.w[7] * self.init_difficulty(EASY) + (1 - self.w[7]) * next_d
+        return np.clip(reverted, 1, 10)
+
+    def short_term_stability(self, stability, rating):
+        return stability * np.exp(self.w[17] * (rating - 3 + self.w[18]))
+
+    def next_recall_stability(self, difficulty, stability, retrievability, rating):
+        penalty = np.where(rating == HARD, self.w[15], 1.0) * np.where(rating == EASY, self.w[16], 1.0)
+        return stability * (
+            1
+            + np.exp(self.w[8])
+            * (11 - difficulty)
+            * np.power(stability, -self.w[9])
+            * (np.exp((1 - retrievability) * self.w[10]) - 1)
+            * penalty
+        )
+
+    def next_forget_stability(self, difficulty, stability, retrievability):
+        return (
+            self.w[11]
+            * np.power(difficulty, -self.w[12])
+            * (np.power(stability + 1, self.w[13]) - 1)
+            * np.exp((1 - retrievability) * self.w[14])
+        )
+
+    def review(self, deck: Dict[str, np.ndarray], ratings: np.ndarray, now: Optional[datetime] = None) -> Dict[str, np.ndarray]:
+        """Returns a new deck with every card reviewed at `now` with its rating (1-4), like FSRS.repeat."""
+        now = np.datetime64((now or datetime.now(timezone.utc)).astimezone(timezone.utc).replace(tzinfo=None), "us")
+        ratings = np.asarray(ratings, dtype=np.int64)
+        state = deck["state"]
+        stability = deck["stability"]
+        difficulty = deck["difficulty"]
+        new = state == NEW
+        learning = (state == LEARNING) | (state == RELEARNING)
+        review = state == REVIEW
+
+        # Not-new cards without a last review would make fsrs fail; treat them as reviewed now
+        since_review = (now - np.where(np.isnat(deck["last_review"]), now, deck["last_review"])) // DAY
+        elapsed_days = np.where(new, 0, since_review).astype(np.int64)
+
+        # Stability after each possible rating; the intervals depend on Hard, Good and Easy together
+        after = {}
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            retrievability = self.forgetting_curve(elapsed_days, stability)
+            for rating in (HARD, GOOD, EASY):
+                after[rating] = np.select(
+                    [new, learning],
+                    [np.full(len(state), self.init_stability(rating)), self.short_term_stability(stability, rating)],
+                    self.next_recall_stability(difficulty, stability, retrievability, np.full(len(state), rating)),
+                )
+            stability_again = np.select(
+                [new, learning],
+                [np.full(len(state), self.init_stability(AGAIN)), self.short_term_stability(stability, AGAIN)],
+                self.next_forget_stability(difficulty, stability, retrievability),
+            )
+            new_stability = np.choose(ratings - 1, [stability_again, after[HARD], after[GOOD], after[EASY]])
+            new_difficulty = np.where(new, self.init_difficulty(ratings), self.next_difficulty(difficulty, ratings))
+
+            hard_interval = np.where(review, self.next_interval(after[HARD]), 0)
+            good_interval = self.next_interval(after[GOOD])
+            hard_interval = np.where(review, np.minimum(hard_interval, good_interval), hard_interval)
+            good_interval = np.where(review, np.maximum(good_interval, hard_interval + 1), good_interval)
+            easy_interval = np.where(new, self.next_interval(after[EASY]), np.maximum(self.next_interval(after[EASY]), good_interval + 1))
+
+        # New cards keep their scheduled_days unless rated Easy
+        scheduled_days = np.choose(ratings - 1, [
+            np.where(new, deck["scheduled_days"], 0),
+            np.where(new, deck["scheduled_days"], hard_interval),
+            np.where(new, deck["scheduled_days"], good_interval),
+            easy_interval,
+        ])
+        due_minutes = np.choose(ratings - 1, [
+            np.where(new, 1, 5),
+            np.where(new, 5, np.where(hard_interval > 0, 0, 10)),
+            np.where(new, 10, 0),
+            0,
+        ])
+        due_days = np.where(new & (ratings != EASY), 0, scheduled_days)
+        due = now + due_days * DAY + due_minutes * MINUTE
+
+        next_state = np.select(
+            [new & (ratings == EASY), new, learning & (ratings >= GOOD), learning, ratings == AGAIN],
+            [REVIEW, LEARNING, REVIEW, state, RELEARNING],
+            REVIEW,
+        ).astype(np.int8)
+        lapses = deck["lapses"] + (review & (ratings == AGAIN))
+
+        return {
+            **deck,
+            "due": due,
+            "stability": new_stability,
+            "difficulty": new_difficulty,
+            "elapsed_days": elapsed_days,
+            "scheduled_days": scheduled_days.astype(np.int64),
+            "reps": deck["reps"] + 1,
+            "lapses": lapses.astype(np.int64),
+            "state": next_state,
+            "last_review": np.full(len(state), now),
+        }
+
+    def reschedule(self, deck: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Returns a new deck whose Review cards are due one interval (from their stability) after their last review.
+
+        Learning, Relearning and New cards are left as they are: their due dates are minutes, not
+        intervals, away and do not depend on the requested retention.
+        """
+        review = (deck["state"] == REVIEW) & ~np.isnat(deck["last_review"]) & (deck["stability"] > 0)
+        interval = np.where(review, self.next_interval(np.where(review, deck["stability"], 1.0)), deck["scheduled_days"])
+        return {
+            **deck,
+            "scheduled_days": interval,
+            "due": np.where(review, deck["last_review"] + interval * DAY, deck["due"]),
+        }
+
+
+def reschedule_user(db: Session, user_id: int, scheduler: Optional[FSRS] = None) -> int:
+    """Recomputes the due dates of a user's whole deck with `scheduler`'s weights and writes them back.
+
+    Returns the number of schedules whose due date changed. The caller commits.
+    """
+    deck = load_schedules(db, user_id)
+    rescheduled = BatchFSRS(scheduler).reschedule(deck)
+    changed = (rescheduled["due"] != deck["due"]) | (rescheduled["scheduled_days"] != deck["scheduled_days"])
+    save_schedules(db, {name: values[changed] for name, values in rescheduled.items()})
+    return int(changed.sum())
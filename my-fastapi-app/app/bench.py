@@ -0,0 +1,384 @@
+"""
+Benchmarks for the database paths of the API.
+
+Run from this directory against a scratch database, e.g.:
+
+    python bench.py due_queue --url sqlite:///bench.db --rows 1000000
+    python bench.py fsrs_batch --rows 100000
+    python bench.py fsrs_optimizer --url sqlite:///bench.db --rows 1000000
+    python bench.py load --target http://127.0.0.1:8000 --clients 200 --requests 20000
+    python bench.py load --path "/main/cardschedule/due_flashcards?limit=1000&fast=true" --introduce 1000 --clients 10 --requests 500
+    python bench.py login_storm --target http://127.0.0.1:8000 --clients 50 --requests 200
+
+The database is created (and seeded) from models.py; never point it at real data.
+fsrs_batch needs no database: it checks BatchFSRS against the fsrs package and times it in memory.
+fsrs_optimizer simulates a review history with known weights and fits them back (see optimizer.py).
+load drives a running server (uvicorn main:app) with concurrent HTTP clients; it needs httpx.
+login_storm logs in from concurrent clients while one more client keeps requesting --path.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from fsrs import FSRS, Card, Rating, State
+from sqlalchemy import create_engine, func, insert
+from sqlalchemy.orm import sessionmaker
+
+import models
+from batch_scheduler import BatchFSRS, from_datetime64, to_datetime64
+from crud import due_cutoff, get_due_flashcard_ids, utc_now
+from optimizer import fit_weights, iter_review_batches, loss_and_gradient
+from review_queue import ReviewQueues
+
+
+def timed(fn, repeat: int):
+    """Runs fn `repeat` times and returns the median and worst run in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), max(samples)
+
+
+def seed_schedules(engine, rows: int, users: int, cards: int, batch_size: int = 10_000):
+    """Fills users, flashcards and cardschedule with `rows` random schedules if cardschedule is empty."""
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        if conn.execute(func.count(models.CardSchedule.id).select()).scalar():
+            return
+        conn.execute(insert(models.User), [{"id": i, "username": f"user{i}", "password": "", "email": f"user{i}@example.com"} for i in range(1, users + 1)])
+        conn.execute(insert(models.Flashcard), [{"id": i, "level": i % 60 + 1, "type": models.FlashcardType.kanji, "fields": ""} for i in range(1, cards + 1)])
+        now = utc_now()
+        batch = []
+        for i in range(rows):
+            batch.append({
+                "user_id": i % users + 1,
+                "flashcard_id": i // users % cards + 1,
+                "due": now + timedelta(minutes=random.randint(-30 * 24 * 60, 30 * 24 * 60)),
+                "last_review": now,
+                "stability": 1.0, "difficulty": 5.0, "elapsed_days": 0, "scheduled_days": 0, "reps": 1, "lapses": 0, "state": "Review",
+            })
+            if len(batch) == batch_size:
+                conn.execute(insert(models.CardSchedule), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(models.CardSchedule), batch)
+
+
+def bench_due_queue(url: str, rows: int, users: int, limit: int, repeat: int):
+    """Times the due queue of random users with the indexed range predicate and with the old function-wrapped one."""
+    engine = create_engine(url)
+    seed_schedules(engine, rows, users, cards=max(rows // users, 1))
+    db = sessionmaker(bind=engine)()
+
+    if engine.dialect.name == "mysql":
+        minute = lambda column: func.date_format(column, "%Y-%m-%d %H:%i:00")
+    else:
+        minute = lambda column: func.strftime("%Y-%m-%d %H:%M:00", column)
+
+    def old_query():
+        user_id = random.randint(1, users)
+        db.query(models.CardSchedule.flashcard_id).filter(
+            models.CardSchedule.user_id == user_id,
+            minute(models.CardSchedule.due) <= minute(due_cutoff() - timedelta(minutes=1)),
+        ).all()
+
+    def new_query():
+        get_due_flashcard_ids(db, random.randint(1, users), limit)
+
+    # The review queues of every user, loaded up front (the API loads them on first use)
+    queues = ReviewQueues(max_users=users)
+    start = time.perf_counter()
+    for user_id in range(1, users + 1):
+        queues.get(db, user_id)
+    print(f"review queues loaded in {(time.perf_counter() - start) / users * 1000:.2f} ms per user")
+
+    def queue_lookup():
+        queues.due_ids(db, random.randint(1, users), limit)
+
+    for name, fn in [("function on due (old)", old_query), ("range on (user_id, due)", new_query), ("review queue heap", queue_lookup)]:
+        median, worst = timed(fn, repeat)
+        print(f"{name:<26} median {median:8.2f} ms   max {worst:8.2f} ms")
+    db.close()
+
+
+def random_cards(count: int, now: datetime):
+    """fsrs Cards spread over every state, with stability, difficulty and last review in realistic ranges."""
+    cards = []
+    for _ in range(count):
+        state = random.choice(list(State))
+        if state == State.New:
+            cards.append(Card(due=now))
+            continue
+        last_review = now - timedelta(minutes=random.randint(0, 400 * 24 * 60))
+        cards.append(Card(
+            due=last_review + timedelta(days=random.randint(0, 100)),
+            stability=random.uniform(0.1, 300), difficulty=random.uniform(1, 10),
+            elapsed_days=random.randint(0, 100), scheduled_days=random.randint(0, 100),
+            reps=random.randint(1, 50), lapses=random.randint(0, 10), state=state, last_review=last_review,
+        ))
+    return cards
+
+
+def cards_to_deck(cards) -> dict:
+    naive = lambda value: value.replace(tzinfo=None) if value else None
+    return {
+        "id": np.arange(len(cards), dtype=np.int64),
+        "due": to_datetime64([naive(card.due) for card in cards]),
+        "stability": np.array([card.stability or 0.0 for card in cards]),
+        "difficulty": np.array([card.difficulty or 0.0 for card in cards]),
+        "elapsed_days": np.array([card.elapsed_days for card in cards], dtype=np.int64),
+        "scheduled_days": np.array([card.scheduled_days for card in cards], dtype=np.int64),
+        "reps": np.array([card.reps for card in cards], dtype=np.int64),
+        "lapses": np.array([card.lapses for card in cards], dtype=np.int64),
+        "state": np.array([card.state.value for card in cards], dtype=np.int8),
+        "last_review": to_datetime64([naive(getattr(card, "last_review", None)) for card in cards]),
+    }
+
+
+def check_fsrs_parity(batch: BatchFSRS, scheduler: FSRS, cards, ratings, now: datetime):
+    """Raises AssertionError unless BatchFSRS.review gives the same cards as FSRS.repeat, one card at a time."""
+    reviewed = batch.review(cards_to_deck(cards), ratings, now)
+    dues = from_datetime64(reviewed["due"])
+    for i, (card, rating) in enumerate(zip(cards, ratings)):
+        expected = scheduler.repeat(card, now)[Rating(int(rating))].card
+        assert np.isclose(reviewed["stability"][i], expected.stability, rtol=1e-9), (i, "stability")
+        assert np.isclose(reviewed["difficulty"][i], expected.difficulty, rtol=1e-9), (i, "difficulty")
+        assert reviewed["scheduled_days"][i] == expected.scheduled_days, (i, "scheduled_days")
+        assert reviewed["elapsed_days"][i] == expected.elapsed_days, (i, "elapsed_days")
+        assert reviewed["state"][i] == expected.state.value, (i, "state")
+        assert reviewed["reps"][i] == expected.reps and reviewed["lapses"][i] == expected.lapses, (i, "counts")
+        assert dues[i] == expected.due.replace(tzinfo=None), (i, "due")
+
+
+def bench_fsrs_batch(rows: int, repeat: int):
+    """Checks BatchFSRS against fsrs on single cards, then times whole-deck review and reschedule against a per-card loop."""
+    now = datetime.now(timezone.utc)
+    scheduler = FSRS(request_retention=0.85)
+    batch = BatchFSRS(scheduler)
+
+    sample = random_cards(5_000, now)
+    check_fsrs_parity(batch, scheduler, sample, np.random.randint(1, 5, len(sample)), now)
+    print(f"parity with fsrs.FSRS.repeat on {len(sample)} cards: ok")
+
+    cards = random_cards(rows, now)
+    deck = cards_to_deck(cards)
+    ratings = np.random.randint(1, 5, rows)
+    loop_rows = min(rows, 10_000)
+
+    def per_card():
+        for card, rating in zip(cards[:loop_rows], ratings[:loop_rows]):
+            scheduler.repeat(card, now)[Rating(int(rating))]
+
+    for name, fn, count in [
+        ("fsrs.repeat per card", per_card, loop_rows),
+        ("BatchFSRS.review", lambda: batch.review(deck, ratings, now), rows),
+        ("BatchFSRS.reschedule", lambda: batch.reschedule(deck), rows),
+    ]:
+        median, worst = timed(fn, repeat)
+        print(f"{name:<22} {count:>8} cards   median {median:9.2f} ms   max {worst:9.2f} ms   {count / median * 1000:12,.0f} cards/s")
+
+
+def seed_review_log(engine, user_id: int, rows: int, true_weights, reviews_per_card: int = 20):
+    """Simulates `rows` reviews of one user whose memory follows `true_weights`, if they have no review_log yet."""
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        if conn.execute(func.count(models.ReviewLog.id).select().where(models.ReviewLog.user_id == user_id)).scalar():
+            return
+        if not conn.execute(func.count(models.User.id).select().where(models.User.id == user_id)).scalar():
+            conn.execute(insert(models.User), [{"id": user_id, "username": f"user{user_id}", "password": "", "email": f"user{user_id}@example.com"}])
+        cards = rows // reviews_per_card
+        first_id = (conn.execute(func.max(models.Flashcard.id).select()).scalar() or 0) + 1
+        conn.execute(insert(models.Flashcard), [{"id": i, "level": i % 60 + 1, "type": models.FlashcardType.vocab, "fields": ""} for i in range(first_id, first_id + cards)])
+
+        rng = np.random.default_rng(0)
+        memory = BatchFSRS(FSRS(w=tuple(true_weights)))
+        state = np.zeros(cards, dtype=np.int8)
+        stability = np.zeros(cards)
+        difficulty = np.zeros(cards)
+        days = np.zeros(cards)
+        last_day = np.zeros(cards)
+        start = datetime(2020, 1, 1)
+        for step in range(reviews_per_card):
+            elapsed = np.where(state == State.New.value, 0, np.floor(days - last_day))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                recalled = rng.random(cards) < memory.forgetting_curve(elapsed, stability)
+            rating = np.where(
+                state == State.Review.value,
+                np.where(recalled, rng.choice([2, 3, 4], cards, p=[0.15, 0.75, 0.1]), 1),
+                rng.choice([1, 2, 3, 4], cards, p=[0.2, 0.1, 0.6, 0.1]),
+            )
+            deck = {
+                "id": np.arange(cards), "due": np.full(cards, np.datetime64(start, "us")), "stability": stability, "difficulty": difficulty,
+                "elapsed_days": elapsed.astype(np.int64), "scheduled_days": np.zeros(cards, dtype=np.int64), "reps": np.zeros(cards, dtype=np.int64),
+                "lapses": np.zeros(cards, dtype=np.int64), "state": state,
+                "last_review": np.where(state == State.New.value, np.datetime64("NaT"), np.datetime64(start, "us") + (last_day * 86_400e6).astype("timedelta64[us]")),
+            }
+            now = start + timedelta(days=float(days.max()) + 1)
+            # Review every card at its own time: shift the deck so that each card is reviewed "now"
+            shift = ((days.max() + 1 - days) * 86_400e6).astype("timedelta64[us]")
+            deck["last_review"] = deck["last_review"] + shift
+            reviewed = memory.review(deck, rating, now.replace(tzinfo=timezone.utc))
+            conn.execute(insert(models.ReviewLog), [
+                {"user_id": user_id, "flashcard_id": first_id + i, "rating": int(rating[i]), "state": State(int(state[i])).name,
+                 "elapsed_days": int(reviewed["elapsed_days"][i]), "scheduled_days": int(reviewed["scheduled_days"][i]),
+                 "review": start + timedelta(days=float(days[i]), seconds=step)}
+                for i in range(cards)
+            ])
+            last_day = days.copy()
+            # Same-day steps stay on the same day; reviews happen on (or up to two days after) the due day
+            days = days + np.where(reviewed["scheduled_days"] > 0, reviewed["scheduled_days"] + rng.integers(0, 3, cards), 0)
+            state, stability, difficulty = reviewed["state"], reviewed["stability"], reviewed["difficulty"]
+
+
+def bench_fsrs_optimizer(url: str, rows: int, chunk_rows: int, epochs: int):
+    """Fits weights to a simulated 1M-review history and reports time, peak memory and how close the fit got."""
+    engine = create_engine(url)
+    user_id = 1
+    default = np.array(FSRS().p.w)
+    true_weights = np.clip(default * np.random.default_rng(1).uniform(0.7, 1.3, len(default)), None, [100] * 7 + [0.75] + [100] * 11)
+    seed_review_log(engine, user_id, rows, true_weights)
+    db = sessionmaker(bind=engine)()
+
+    def mean_loss(weights):
+        total = predictions = 0
+        for chunk in iter_review_batches(db, user_id, chunk_rows):
+            loss, _, count = loss_and_gradient(np.asarray(weights), chunk)
+            total += loss
+            predictions += count
+        return total / predictions
+
+    result = fit_weights(db, user_id, epochs=epochs, chunk_rows=chunk_rows)
+    # tracemalloc slows numpy down a lot, so measure memory on a separate one-epoch fit
+    tracemalloc.start()
+    fit_weights(db, user_id, epochs=1, chunk_rows=chunk_rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{result['reviews']:,} reviews ({result['predictions']:,} predictions), {epochs} epochs, chunks of {chunk_rows:,} rows")
+    print(f"fit in {result['seconds']:.1f} s, {result['reviews'] * epochs / result['seconds']:,.0f} reviews/s, peak traced memory {peak / 2**20:.0f} MiB")
+    print(f"log loss: default weights {mean_loss(default):.4f}   fitted {result['loss']:.4f}   true {mean_loss(true_weights):.4f}")
+    db.close()
+
+
+async def run_load(target: str, path: str, clients: int, requests: int, introduce: int = 0, username: str = "loadtest", password: str = "loadtest"):
+    """Logs in (and introduces `introduce` new cards), then sends `requests` GETs of `path` from `clients`
+    concurrent connections; returns latencies and errors."""
+    import httpx
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=60) as client:
+        await client.post("/auth/register", json={"username": username, "password": password, "email": f"{username}@example.com"})
+        token = (await client.post("/auth/token", data={"username": username, "password": password})).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        if introduce:
+            await client.post("/main/cardschedule/introduce", params={"count": introduce}, headers=headers)
+        if path.startswith("/main/cardschedule/") and (await client.get(path, headers=headers)).status_code == 404:
+            await client.post("/main/cardschedule/new_add_flashcard", headers=headers)
+
+        latencies, errors = [], 0
+        remaining = iter(range(requests))
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                response = await client.get(path, headers=headers)
+                latencies.append((time.perf_counter() - start) * 1000)
+                errors += response.status_code != 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(clients)))
+        return latencies, errors, time.perf_counter() - start
+
+
+def bench_load(target: str, path: str, clients: int, requests: int, introduce: int = 0):
+    """Throughput and latency of one endpoint of a running server under `clients` concurrent clients."""
+    latencies, errors, seconds = asyncio.run(run_load(target, path, clients, requests, introduce))
+    latencies.sort()
+    p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+    print(f"{requests} x GET {path} from {clients} clients: {requests / seconds:,.0f} req/s   p50 {p50:.1f} ms   p99 {p99:.1f} ms   errors {errors}")
+
+
+def percentiles(latencies: list) -> str:
+    latencies = sorted(latencies)
+    if not latencies:
+        return "no requests"
+    return f"p50 {latencies[len(latencies) // 2]:.1f} ms   p99 {latencies[int(len(latencies) * 0.99)]:.1f} ms"
+
+
+async def run_login_storm(target: str, path: str, clients: int, requests: int, username: str = "loadtest", password: str = "loadtest"):
+    """Sends `requests` logins from `clients` concurrent connections while one more client GETs `path` in a loop."""
+    import httpx
+
+    limits = httpx.Limits(max_connections=clients + 1, max_keepalive_connections=clients + 1)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=120) as client:
+        await client.post("/auth/register", json={"username": username, "password": password, "email": f"{username}@example.com"})
+        token = (await client.post("/auth/token", data={"username": username, "password": password})).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        logins, probes, errors = [], [], {}
+        remaining = iter(range(requests))
+        done = asyncio.Event()
+
+        async def login():
+            for _ in remaining:
+                start = time.perf_counter()
+                response = await client.post("/auth/token", data={"username": username, "password": password})
+                logins.append((time.perf_counter() - start) * 1000)
+                if response.status_code != 200:
+                    errors[response.status_code] = errors.get(response.status_code, 0) + 1
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get(path, headers=headers)
+                probes.append((time.perf_counter() - start) * 1000)
+                await asyncio.sleep(0.01)
+
+        start = time.perf_counter()
+        prober = asyncio.ensure_future(probe())
+        await asyncio.gather(*(login() for _ in range(clients)))
+        done.set()
+        await prober
+        return logins, probes, errors, time.perf_counter() - start
+
+
+def bench_login_storm(target: str, path: str, clients: int, requests: int):
+    """Login latency under `clients` concurrent logins, and what the storm does to another endpoint."""
+    logins, probes, errors, seconds = asyncio.run(run_login_storm(target, path, clients, requests))
+    print(f"{requests} logins from {clients} clients in {seconds:.1f} s: {requests / seconds:,.1f} logins/s   {percentiles(logins)}   errors {errors or 0}")
+    print(f"GET {path} meanwhile: {len(probes)} requests   {percentiles(probes)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=["due_queue", "fsrs_batch", "fsrs_optimizer", "load", "login_storm"])
+    parser.add_argument("--url", default="sqlite:///bench.db")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--chunk-rows", type=int, default=200_000)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="base URL of the server for load")
+    parser.add_argument("--path", default="/main/cardschedule/1", help="endpoint for load and login_storm")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--introduce", type=int, default=0, help="new cards to schedule for the load user first (e.g. for the due list)")
+    args = parser.parse_args()
+    if args.benchmark == "fsrs_batch":
+        bench_fsrs_batch(args.rows, args.repeat)
+    elif args.benchmark == "fsrs_optimizer":
+        bench_fsrs_optimizer(args.url, args.rows, args.chunk_rows, args.epochs)
+    elif args.benchmark == "load":
+        bench_load(args.target, args.path, args.clients, args.requests, args.introduce)
+    elif args.benchmark == "login_storm":
+        bench_login_storm(args.target, args.path, args.clients, args.requests)
+    else:
+        bench_due_queue(args.url, args.rows, args.users, args.limit, args.repeat)
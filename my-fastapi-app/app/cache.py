@@ -0,0 +1,195 @@
+"""
+In-process cache of the flashcard catalog.
+
+The flashcards table only changes when a deck is imported, so the API keeps read-only
+FlashcardBase snapshots of the rows it has seen, by id and by (level, type), and the sorted
+list of all flashcard ids. Both maps are LRU bounded. The importer bumps
+catalog_version.version after every import; the cache reads that stamp at most once every
+`version_check_interval` seconds and drops everything when it changed, so the review hot
+path normally needs no database round trip.
+"""
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import models
+from schemas import FlashcardBase
+
+
+class LRUCache:
+    """A size bounded mapping that evicts the least recently used entry and counts hits and misses."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        return self._data.pop(key, None)
+
+    def oldest(self):
+        """The least recently used (key, value), or None when empty; does not count as a use."""
+        return next(iter(self._data.items()), None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def snapshot(row: models.Flashcard) -> FlashcardBase:
+    """Copies a Flashcard row into an immutable-by-convention schema object that outlives its session."""
+    return FlashcardBase(id=row.id, level=row.level, type=row.type.value, fields=row.fields, field_values=row.field_values)
+
+
+class FlashcardCatalog:
+    """Read-through cache of flashcards by id and by (level, type)."""
+
+    def __init__(self, max_cards: int = 50_000, max_groups: int = 512, version_check_interval: float = 5.0):
+        self.by_id = LRUCache(max_cards)
+        self.by_group = LRUCache(max_groups)
+        self.ids = None
+        self.version_check_interval = version_check_interval
+        self.version = None
+        self.invalidations = 0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _check_version(self, db: Session):
+        # Called with the lock held
+        now = time.monotonic()
+        if now - self._checked_at < self.version_check_interval:
+            return
+        self._checked_at = now
+        version = db.query(models.CatalogVersion.version).filter(models.CatalogVersion.id == 1).scalar() or 0
+        if version != self.version:
+            if self.version is not None:
+                self.invalidations += 1
+            self.by_id.clear()
+            self.by_group.clear()
+            self.ids = None
+            self.version = version
+
+    def current_version(self, db: Session) -> str:
+        """catalog_version.version, which the importer bumps whenever the catalog changes, read from
+        the database at most once every `version_check_interval` seconds (e.g. for ETags)."""
+        with self._lock:
+            self._check_version(db)
+            return str(self.version)
+
+    def get(self, db: Session, flashcard_id: int) -> Optional[FlashcardBase]:
+        return self.get_many(db, [flashcard_id]).get(flashcard_id)
+
+    def get_many(self, db: Session, flashcard_ids: Iterable[int]) -> Dict[int, FlashcardBase]:
+        """Returns the cards with the given ids (missing ids are left out), loading the uncached ones in one query."""
+        found = {}
+        missing = []
+        with self._lock:
+            self._check_version(db)
+            version = self.version
+            for flashcard_id in flashcard_ids:
+                card = self.by_id.get(flashcard_id)
+                if card is None:
+                    missing.append(flashcard_id)
+                else:
+                    found[flashcard_id] = card
+        if missing:
+            rows = db.query(models.Flashcard).filter(models.Flashcard.id.in_(missing)).all()
+            with self._lock:
+                # Not cached if the catalog changed meanwhile: the rows may be from the old import
+                store = self.version == version
+                for row in rows:
+                    card = snapshot(row)
+                    if store:
+                        self.by_id.put(card.id, card)
+                    found[card.id] = card
+        return found
+
+    def get_group(self, db: Session, level: int, flashcard_type: str) -> Tuple[List[int], List[FlashcardBase]]:
+        """Returns the ids and the cards of a level and type, in id order."""
+        key = (level, flashcard_type)
+        with self._lock:
+            self._check_version(db)
+            version = self.version
+            group = self.by_group.get(key)
+        if group is None:
+            rows = db.query(models.Flashcard).filter(
+                models.Flashcard.level == level,
+                models.Flashcard.type == models.FlashcardType(flashcard_type),
+            ).order_by(models.Flashcard.id).all()
+            cards = [snapshot(row) for row in rows]
+            group = ([card.id for card in cards], cards)
+            with self._lock:
+                if self.version == version:
+                    self.by_group.put(key, group)
+                    for card in cards:
+                        self.by_id.put(card.id, card)
+        return group
+
+    def page_group(self, db: Session, level: int, flashcard_type: str, after_id: int, limit: int):
+        """Keyset page over a cached (level, type) group: the cards after `after_id` and whether more follow."""
+        ids, cards = self.get_group(db, level, flashcard_type)
+        start = bisect_right(ids, after_id)
+        page = cards[start:start + limit]
+        return page, start + limit < len(cards)
+
+    def next_id(self, db: Session, after_id: int) -> Optional[int]:
+        """The smallest flashcard id greater than `after_id`, or None, from the cached id list of the whole catalog."""
+        with self._lock:
+            self._check_version(db)
+            version = self.version
+            ids = self.ids
+        if ids is None:
+            ids = [flashcard_id for flashcard_id, in db.query(models.Flashcard.id).order_by(models.Flashcard.id).all()]
+            with self._lock:
+                if self.version == version:
+                    self.ids = ids
+        index = bisect_right(ids, after_id)
+        return ids[index] if index < len(ids) else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "version": self.version,
+                "invalidations": self.invalidations,
+                "by_id": self.by_id.stats(),
+                "by_group": self.by_group.stats(),
+            }
+
+
+flashcard_catalog = FlashcardCatalog()
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+from fsrs import State
+from sqlalchemy import exists, func, insert, literal, select, text
+from sqlalchemy.orm import Session
+
+import models
+
+
+def utc_now() -> datetime:
+    """
+    The current time as a naive UTC datetime, the convention of the due and last_review
+    columns: scheduler.schedule_values writes UTC, and the CURRENT_TIMESTAMP defaults are UTC
+    (SQLite always, MySQL because db.py sets the session time zone to UTC).
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def due_cutoff(now: datetime = None) -> datetime:
+    """
+    Start of the minute after `now` (naive UTC, default utc_now()). A card is due when its due
+    time, down to the minute, is not later than the current minute, i.e. when due < due_cutoff().
+    """
+    now = now or utc_now()
+    return now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+
+
+def get_due_flashcard_ids(db: Session, user_id: int, limit: int, now: datetime = None) -> List[int]:
+    """
+    Returns the ids of the flashcards a user has due, soonest first, at most `limit` of them.
+
+    The predicate compares the bare due column with a constant so MySQL can answer it with a
+    range scan on the (user_id, due) index, already in due order.
+    """
+    rows = db.query(models.CardSchedule.flashcard_id).filter(
+        models.CardSchedule.user_id == user_id,
+        models.CardSchedule.due < due_cutoff(now),
+    ).order_by(models.CardSchedule.due).limit(limit).all()
+    return [flashcard_id for flashcard_id, in rows]
+
+
+def add_minutes(column, minutes: int, dialect_name: str):
+    """SQL expression for `column` shifted by `minutes` (MySQL TIMESTAMPADD, SQLite datetime modifiers)."""
+    if dialect_name == "sqlite":
+        return func.datetime(column, f"{minutes:+d} minutes")
+    return func.timestampadd(text("MINUTE"), minutes, column)
+
+
+def shift_due(db: Session, user_id: int, flashcard_ids: Iterable[int], minutes: int) -> List[int]:
+    """
+    Moves the due time of some of a user's cards by `minutes` with one set-based UPDATE
+    (UPDATE cardschedule SET due = due + INTERVAL ... WHERE user_id = ? AND flashcard_id IN (...)).
+
+    Returns the ids that are not in the user's schedule. The caller commits.
+    """
+    flashcard_ids = set(flashcard_ids)
+    if not flashcard_ids:
+        return []
+    in_schedule = models.CardSchedule.user_id == user_id, models.CardSchedule.flashcard_id.in_(flashcard_ids)
+    found = {flashcard_id for flashcard_id, in db.query(models.CardSchedule.flashcard_id).filter(*in_schedule).all()}
+    if found:
+        db.query(models.CardSchedule).filter(*in_schedule).update(
+            {models.CardSchedule.due: add_minutes(models.CardSchedule.due, minutes, db.get_bind().dialect.name)},
+            synchronize_session=False,
+        )
+    return sorted(flashcard_ids - found)
+
+
+def introduce_flashcards(db: Session, user_id: int, count: int, level: Optional[int] = None, flashcard_type: Optional[str] = None) -> list:
+    """
+    Adds the first `count` flashcards (in id order, optionally of one level and type) that are
+    not in the user's schedule yet as New cards, with one INSERT ... SELECT ... NOT EXISTS.
+
+    Returns the created schedules (rows of every cardschedule column) in flashcard order. The
+    caller commits.
+    """
+    flashcards = select(
+        models.Flashcard.id, literal(user_id), literal(0.0), literal(0.0), literal(0), literal(0), literal(0), literal(0), literal(State.New.name),
+    ).where(~exists().where(models.CardSchedule.user_id == user_id, models.CardSchedule.flashcard_id == models.Flashcard.id))
+    if level is not None:
+        flashcards = flashcards.where(models.Flashcard.level == level)
+    if flashcard_type is not None:
+        flashcards = flashcards.where(models.Flashcard.type == models.FlashcardType(flashcard_type))
+    flashcards = flashcards.order_by(models.Flashcard.id).limit(count)
+
+    # The new rows are the user's rows with a higher id than any they had before
+    last_id = db.query(func.max(models.CardSchedule.id)).filter(models.CardSchedule.user_id == user_id).scalar() or 0
+    columns = ["flashcard_id", "user_id", "stability", "difficulty", "elapsed_days", "scheduled_days", "reps", "lapses", "state"]
+    db.execute(insert(models.CardSchedule).from_select(columns, flashcards))
+    # Plain rows rather than CardSchedule objects, which the commit would expire
+    return db.query(*models.CardSchedule.__table__.columns).filter(
+        models.CardSchedule.user_id == user_id,
+        models.CardSchedule.id > last_id,
+    ).order_by(models.CardSchedule.flashcard_id).all()
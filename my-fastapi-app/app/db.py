@@ -1,8 +1,14 @@
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from starlette.concurrency import run_in_threadpool
 
+import asyncio
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -12,7 +18,122 @@ load_dotenv()
 
 URL_DATABASE = os.getenv('URL_DATABASE')
 
-engine = create_engine(URL_DATABASE)
+# Connection pool settings. Connections are pinged before use (so one the server closed
+# fails over to a new connection instead of the request) and replaced after DB_POOL_RECYCLE
+# seconds, below MySQL's wait_timeout. A request waits at most DB_POOL_TIMEOUT seconds for
+# one of the DB_POOL_SIZE + DB_MAX_OVERFLOW connections.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '3600'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'yes')
+
+
+class PoolMetrics:
+    """Counts the checkouts of a pool, how long they waited and how often they timed out,
+    plus the connections it opened, invalidated (e.g. failed pre-pings) and closed."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connects = 0
+        self.invalidations = 0
+        self.closes = 0
+        self._lock = threading.Lock()
+
+    def waited(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def watch(self, engine):
+        """Counts the connection events of an engine's pool (they stay attached when the pool is recreated)."""
+        event.listen(engine, "connect", lambda *args: self.count("connects"))
+        event.listen(engine, "invalidate", lambda *args: self.count("invalidations"))
+        event.listen(engine, "close", lambda *args: self.count("closes"))
+
+    def stats(self, pool) -> dict:
+        with self._lock:
+            stats = {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_mean_ms": self.wait_total / self.checkouts * 1e3 if self.checkouts else 0.0,
+                "wait_max_ms": self.wait_max * 1e3,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "closes": self.closes,
+            }
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(), capacity=pool_capacity(pool), in_use=pool.checkedout(), idle=pool.checkedin(), overflow=max(pool.overflow(), 0))
+        return stats
+
+
+class MeteredPool:
+    """Mixin for a QueuePool class that times every checkout into its `metrics`."""
+
+    metrics: PoolMetrics
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.waited(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.waited(time.perf_counter() - start)
+        return connection
+
+
+def pool_options(url: str, pool_class=QueuePool, metrics: PoolMetrics = None) -> dict:
+    """create_engine arguments for the pool settings above. In-memory SQLite databases keep
+    their default pool: every new connection would be a new, empty database."""
+    url = make_url(url)
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return options
+    if metrics is not None:
+        pool_class = type("Metered" + pool_class.__name__, (MeteredPool, pool_class), {"metrics": metrics})
+    return {**options, "poolclass": pool_class, "pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+
+
+def pool_capacity(pool):
+    """How many connections a pool hands out at most, or None when it has no limit."""
+    max_overflow = getattr(pool, "_max_overflow", None)
+    if max_overflow is None or max_overflow < 0:
+        return None
+    return pool.size() + max_overflow
+
+
+pool_metrics = PoolMetrics()
+
+engine = create_engine(URL_DATABASE, **pool_options(URL_DATABASE, metrics=pool_metrics))
+pool_metrics.watch(engine)
+
+
+def use_utc_sessions(engine):
+    """Makes MySQL sessions use UTC, so CURRENT_TIMESTAMP defaults and TIMESTAMP columns hold
+    naive UTC like the values the app writes (see crud.utc_now). SQLite is UTC already."""
+    if engine.dialect.name != "mysql":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_time_zone(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET time_zone = '+00:00'")
+        cursor.close()
+
+
+use_utc_sessions(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -23,6 +144,99 @@ def get_db():
     finally:
         db.close()
 
+
+# Async database access for the async routes. DB_ASYNC=1 gives them an AsyncSession on an
+# async driver: ASYNC_URL_DATABASE if set, else URL_DATABASE with its driver swapped
+# (mysql -> asyncmy, sqlite -> aiosqlite). Otherwise they get a normal Session whose calls
+# run in the threadpool. Either way execute/commit/refresh below never block the event loop.
+# Threadpool sessions are capped at the pool's capacity so that no worker thread waits for a
+# connection held by a request that is itself waiting for a thread.
+ASYNC_DRIVERS = {"mysql": "mysql+asyncmy", "sqlite": "sqlite+aiosqlite"}
+
+DB_ASYNC = os.getenv('DB_ASYNC', '0').lower() in ('1', 'true', 'yes')
+
+
+def async_url(url: str) -> str:
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername)).render_as_string(hide_password=False)
+
+
+if DB_ASYNC:
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    ASYNC_URL_DATABASE = os.getenv('ASYNC_URL_DATABASE') or async_url(URL_DATABASE)
+    async_pool_metrics = PoolMetrics()
+    async_engine = create_async_engine(ASYNC_URL_DATABASE, **pool_options(ASYNC_URL_DATABASE, AsyncAdaptedQueuePool, async_pool_metrics))
+    async_pool_metrics.watch(async_engine.sync_engine)
+    use_utc_sessions(async_engine.sync_engine)
+    AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+else:
+    AsyncSession = None
+    async_pool_metrics = None
+    async_engine = None
+    AsyncSessionLocal = None
+
+
+
+
+# Created on first use: on Python < 3.10 an asyncio primitive binds to the event loop current
+# at creation, which at import time is not the one uvicorn serves requests on
+_threadpool_sessions = None
+
+
+def threadpool_sessions() -> asyncio.Semaphore:
+    global _threadpool_sessions
+    if _threadpool_sessions is None:
+        _threadpool_sessions = asyncio.Semaphore(pool_capacity(engine.pool) or 1_000_000)
+    return _threadpool_sessions
+
+
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        async with threadpool_sessions():
+            db = SessionLocal()
+            try:
+                yield db
+            finally:
+                await run_in_threadpool(db.close)
+        return
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def is_async(db) -> bool:
+    return AsyncSession is not None and isinstance(db, AsyncSession)
+
+
+async def execute(db, statement):
+    """Runs a statement on a session from get_async_db without blocking the event loop."""
+    if is_async(db):
+        return await db.execute(statement)
+    return await run_in_threadpool(db.execute, statement)
+
+
+async def commit(db):
+    if is_async(db):
+        await db.commit()
+    else:
+        await run_in_threadpool(db.commit)
+
+
+async def refresh(db, instance):
+    if is_async(db):
+        await db.refresh(instance)
+    else:
+        await run_in_threadpool(db.refresh, instance)
+
+
+def pool_stats() -> dict:
+    """Metrics of the connection pools (GET /metrics)."""
+    stats = {"db_pool": pool_metrics.stats(engine.pool)}
+    if async_engine is not None:
+        stats["async_db_pool"] = async_pool_metrics.stats(async_engine.sync_engine.pool)
+    return stats
+
 '''
 import mysql.connector
 class Database:
@@ -0,0 +1,41 @@
+"""
+Opt-in fast path for list responses.
+
+By default a list endpoint returns ORM objects (or schema snapshots) that FastAPI validates
+against the response model attribute by attribute and then encodes with the stdlib json.
+With ?fast=true the list endpoints instead hand plain tuples to orjson in an ORJSONResponse:
+no per-object validation and a C encoder. Pages read from the database select column tuples
+instead of ORM objects; cards served from the catalog cache are turned into tuples directly,
+since querying them again would cost more than it saves. The JSON is the same objects with
+the same keys.
+"""
+from typing import Dict, Iterable, Optional, Sequence
+
+from fastapi.responses import ORJSONResponse
+
+import models
+from schemas import FlashcardBase
+
+
+# The columns of a FlashcardBase, in its field order
+FLASHCARD_COLUMNS = (
+    models.Flashcard.id,
+    models.Flashcard.level,
+    models.Flashcard.type,
+    models.Flashcard.fields,
+    models.Flashcard.field_values,
+)
+FLASHCARD_NAMES = tuple(column.key for column in FLASHCARD_COLUMNS)
+
+
+def flashcard_rows(cards: Iterable[FlashcardBase]):
+    """The FLASHCARD_COLUMNS values of FlashcardBase snapshots (e.g. from the catalog cache), as tuples."""
+    return ((card.id, card.level, card.type, card.fields, card.field_values) for card in cards)
+
+
+def rows_response(rows: Iterable, names: Sequence[str] = None, headers: Optional[Dict[str, str]] = None) -> ORJSONResponse:
+    """Encodes query rows as a JSON list of objects keyed by `names` (default: the rows' own column names)."""
+    rows = list(rows)
+    if names is None:
+        names = rows[0]._fields if rows else ()
+    return ORJSONResponse([dict(zip(names, row)) for row in rows], headers=headers)
@@ -0,0 +1,43 @@
+"""
+Conditional GET helpers.
+
+A response that only depends on the catalog gets a strong ETag made from the catalog
+version (FlashcardCatalog.current_version) and the request parameters that select the
+content. A client that sends the ETag back in If-None-Match gets an empty 304 as long as
+the catalog has not changed, without the query being run. Cache-Control lets clients reuse
+a response for CATALOG_MAX_AGE seconds before they revalidate; it is private because the
+routes require a token.
+"""
+import hashlib
+import os
+from typing import Dict, Optional
+
+from fastapi import Response
+from starlette import status
+
+
+CATALOG_MAX_AGE = int(os.getenv('CATALOG_MAX_AGE', '60'))
+
+
+def make_etag(*parts) -> str:
+    """A strong ETag for the content identified by `parts`."""
+    digest = hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header covers `etag` (weak comparison, as RFC 7232 asks for If-None-Match)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def cache_headers(etag: str, max_age: int = CATALOG_MAX_AGE) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": f"private, max-age={max_age}"}
+
+
+def not_modified(headers: Dict[str, str]) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
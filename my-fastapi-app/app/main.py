@@ -9,17 +9,31 @@ import models
 # Importing FlashcardBase from schemas for request and response handling
 from schemas import FlashcardBase, UserBase
 # Importing engine and get_db from db for database session management
-from db import engine, get_db
+from db import engine, async_engine, get_db
 # Importing auth route for authentication
 
 from auth import get_current_user
-from router import auth_router, main_router
+from router import auth_router, main_router, metrics_router
+from review_log import review_log_writer
 
 
 app = FastAPI()
 models.Base.metadata.create_all(bind=engine)
 app.include_router(auth_router)
 app.include_router(main_router)
+app.include_router(metrics_router)
+
+
+# Write the review log rows still buffered in memory before the process exits
+@app.on_event("shutdown")
+def flush_review_log():
+    review_log_writer.close()
+
+
+@app.on_event("shutdown")
+async def close_async_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
 
 
 '''
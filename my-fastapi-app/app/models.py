@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, Text, JSON, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine, Column, Integer, String, Enum as SQLAlchemyEnum
 
@@ -18,14 +18,25 @@ class Flashcard(Base):
     __tablename__ = "flashcards"
     
     id = Column(Integer, primary_key=True, index=True)
+    guid = Column(String(64), unique=True, index=True)  # Anki note guid, the key used when re-importing a deck
     level = Column(Integer, index=True)
     type = Column(SQLAlchemyEnum(FlashcardType), index=True)
-    fields = Column(String(255))
+    fields = Column(Text)
+    field_values = Column(JSON)  # note fields by name, e.g. {"Meaning": ..., "Reading": ...}, parsed at import time
     
     class Config:
         from_attributes = True
     
 
+# Stamp bumped by the importer (Data Processing/Anki2db.py) every time the flashcards change,
+# so the API can tell when its cached copy of the catalog is stale (see cache.py)
+class CatalogVersion(Base):
+    __tablename__ = "catalog_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
 #User SQLAlchemy model for users
 class User(Base):
     __tablename__ = "users"
@@ -36,7 +47,7 @@ class User(Base):
     email = Column(String(64), unique=True, index=True)
     created_at = Column(DateTime)
 
-from sqlalchemy import Column, Integer, Float, String, DateTime, ForeignKey, TIMESTAMP
+from sqlalchemy import Column, Integer, Float, String, DateTime, ForeignKey, Index, TIMESTAMP, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -62,6 +73,44 @@ class CardSchedule(Base):
     flashcard = relationship("Flashcard", back_populates="schedules")
     user = relationship("User", back_populates="schedules")
 
+    # The due queue of a user is a range scan on this index (see crud.get_due_flashcard_ids);
+    # a card is scheduled at most once per user, even when two workers add it at the same time
+    __table_args__ = (
+        Index("ix_cardschedule_user_id_due", "user_id", "due"),
+        UniqueConstraint("user_id", "flashcard_id", name="uq_cardschedule_user_id_flashcard_id"),
+    )
+
+#### ReviewLog model
+
+# One row per review, appended and never updated (see review_log.py). The state is the one the
+# card was in before the review and elapsed_days the days since the review before it, as in fsrs.ReviewLog
+class ReviewLog(Base):
+    __tablename__ = "review_log"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    flashcard_id = Column(Integer, ForeignKey("flashcards.id", ondelete="CASCADE"), nullable=False)
+    rating = Column(Integer, nullable=False)
+    state = Column(String(50))
+    elapsed_days = Column(Integer)
+    scheduled_days = Column(Integer)
+    review = Column(DateTime, nullable=False)
+
+    # A user's history is read card by card in review order (e.g. to fit FSRS weights)
+    __table_args__ = (Index("ix_review_log_user_id_flashcard_id_review", "user_id", "flashcard_id", "review"),)
+
+#### FSRSParams model
+
+# Personal FSRS weights of a user, fitted from their review_log by optimizer.py
+class FSRSParams(Base):
+    __tablename__ = "fsrs_params"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    weights = Column(JSON, nullable=False)  # the 19 FSRS weights, as for fsrs.FSRS(w=...)
+    reviews = Column(Integer)  # number of review_log rows the weights were fitted on
+    loss = Column(Float)  # mean log loss of the fitted weights on those reviews
+    fitted_at = Column(DateTime)
+
 # Add these to the existing models for relationships
 Flashcard.schedules = relationship("CardSchedule", back_populates="flashcard", cascade="all, delete-orphan")
 User.schedules = relationship("CardSchedule", back_populates="user", cascade="all, delete-orphan")
@@ -0,0 +1,402 @@
+"""
+Fits personal FSRS weights to a user's review history.
+
+The review_log rows of a user are read card by card (ordered by flashcard and time) in
+chunks of `chunk_rows`, so memory stays bounded by the chunk size whatever the history. Each
+chunk is replayed with the same formulas as the scheduler (see batch_scheduler.BatchFSRS):
+New reviews set the initial stability and difficulty, Learning/Relearning reviews use the
+short-term stability and Review reviews the recall or forget stability. Every review of a
+card in the Review state is a prediction: the retrievability the weights gave it against
+whether it was recalled (rating above Again). The weights minimise the mean log loss of those
+predictions with Adam (cosine-annealed learning rate), one step per batch of cards. The gradient is carried forward through
+the replay alongside stability and difficulty, for all cards of a batch at once. The log is
+read from the database once; later epochs reread it from a temporary spool of .npz chunks.
+
+The fitted weights go to fsrs_params, where scheduler.user_scheduler picks them up; a running
+server does so within the `ttl` of its scheduler cache and review queues (5 minutes).
+
+    python optimizer.py --user-id 42 [--reschedule]
+    python optimizer.py --all
+"""
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fsrs import FSRS, Rating, State
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models
+from scheduler import parse_state
+
+
+NUM_WEIGHTS = 19
+NEW, LEARNING, REVIEW, RELEARNING = (state.value for state in State)
+
+# Ranges the weights are kept in after every step, as in the reference FSRS optimizer
+WEIGHT_BOUNDS = np.array([
+    (0.1, 100), (0.1, 100), (0.1, 100), (0.1, 100),
+    (1, 10), (0.001, 4), (0.001, 4), (0.001, 0.75),
+    (0, 4.5), (0, 0.8), (0.001, 3.5), (0.001, 5),
+    (0.001, 0.25), (0.001, 0.9), (0, 4), (0, 1),
+    (1, 6), (0, 2), (0, 2),
+])
+
+MIN_STABILITY = 0.01
+MIN_PREDICTIONS = 100
+
+
+class ReviewBatch:
+    """The reviews of a set of cards as arrays, sorted by card and time.
+
+    Cards whose history does not start with a New review are left out: the replay needs
+    to know their first stability and difficulty.
+    """
+
+    def __init__(self, card: np.ndarray, rating: np.ndarray, state: np.ndarray, elapsed_days: np.ndarray):
+        if len(card):
+            starts = np.flatnonzero(np.r_[True, card[1:] != card[:-1]])
+            lengths = np.diff(np.r_[starts, len(card)])
+            keep = np.repeat(state[starts] == NEW, lengths)
+            card, rating, state, elapsed_days = card[keep], rating[keep], state[keep], elapsed_days[keep]
+        if len(card) == 0:
+            # No card (left) whose history starts with a New review
+            self.card = self.position = np.zeros(0, dtype=np.int64)
+            self.rating = np.zeros(0, dtype=np.int64)
+            self.state = np.zeros(0, dtype=np.int8)
+            self.elapsed_days = np.zeros(0, dtype=np.float64)
+            self.cards = 0
+            self.steps = []
+            return
+        starts = np.flatnonzero(np.r_[True, card[1:] != card[:-1]])
+        lengths = np.diff(np.r_[starts, len(card)])
+        # Cards renumbered 0..n-1 and the position of every review within its card
+        self.card = np.repeat(np.arange(len(starts)), lengths)
+        self.position = np.arange(len(card)) - np.repeat(starts, lengths)
+        self.rating = rating.astype(np.int64)
+        self.state = state.astype(np.int8)
+        self.elapsed_days = elapsed_days.astype(np.float64)
+        self.cards = len(starts)
+        order = np.argsort(self.position, kind="stable")
+        bounds = np.searchsorted(self.position[order], np.arange(self.position.max() + 2))
+        # Rows of the k-th review of every card, for k = 0, 1, ...
+        self.steps = [order[bounds[k]:bounds[k + 1]] for k in range(len(bounds) - 1)]
+
+    def __len__(self):
+        return len(self.card)
+
+    def split(self, batch_cards: int) -> Iterator["ReviewBatch"]:
+        """Smaller batches of at most `batch_cards` cards each."""
+        starts = np.searchsorted(self.card, np.arange(0, self.cards, batch_cards))
+        for start, end in zip(starts, np.r_[starts[1:], len(self.card)]):
+            rows = slice(start, end)
+            yield ReviewBatch(self.card[rows], self.rating[rows], self.state[rows], self.elapsed_days[rows])
+
+
+def iter_review_batches(db: Session, user_id: int, chunk_rows: int = 200_000) -> Iterator[ReviewBatch]:
+    """Reads a user's review_log as ReviewBatches of at most about `chunk_rows` reviews, never splitting a card.
+
+    Chunks are keyset pages on flashcard_id (served by the (user_id, flashcard_id, review) index),
+    so only one chunk is held in memory at a time on every database driver.
+    """
+    log = models.ReviewLog
+    query = select(log.flashcard_id, log.rating, log.state, log.elapsed_days).where(log.user_id == user_id).order_by(log.flashcard_id, log.review, log.id)
+    conn = db.connection()
+    after = None
+    while True:
+        page = query if after is None else query.where(log.flashcard_id > after)
+        rows = conn.execute(page.limit(chunk_rows)).all()
+        if len(rows) < chunk_rows:
+            if rows:
+                yield to_review_batch(rows)
+            return
+        # The last card may go on in the next page: leave it for the next one
+        last = rows[-1][0]
+        cut = len(rows)
+        while cut and rows[cut - 1][0] == last:
+            cut -= 1
+        if cut == 0:
+            # A single card with more than chunk_rows reviews
+            rows = conn.execute(query.where(log.flashcard_id == last)).all()
+            cut = len(rows)
+        yield to_review_batch(rows[:cut])
+        after = rows[cut - 1][0]
+
+
+def to_review_batch(rows: Sequence[tuple]) -> ReviewBatch:
+    states = {value: parse_state(value).value for value in {row[2] for row in rows}}
+    return ReviewBatch(
+        np.array([row[0] for row in rows], dtype=np.int64),
+        np.array([row[1] for row in rows], dtype=np.int64),
+        np.array([states[row[2]] for row in rows], dtype=np.int8),
+        np.array([row[3] or 0 for row in rows], dtype=np.float64),
+    )
+
+
+def spool_review_batches(db: Session, user_id: int, directory: str, chunk_rows: int = 200_000) -> List[Tuple[str, int]]:
+    """Reads a user's review_log once into one .npz file per chunk in `directory`, for the later epochs.
+
+    Returns the path and the number of cards of every chunk; chunks left without a card
+    (none of their cards' histories starts with a New review) are not spooled.
+    """
+    chunks = []
+    for number, batch in enumerate(iter_review_batches(db, user_id, chunk_rows)):
+        if not batch.cards:
+            continue
+        path = os.path.join(directory, f"chunk{number}.npz")
+        np.savez(path, card=batch.card, rating=batch.rating, state=batch.state, elapsed_days=batch.elapsed_days)
+        chunks.append((path, batch.cards))
+    return chunks
+
+
+def load_review_batches(chunks: Sequence[Tuple[str, int]]) -> Iterator[ReviewBatch]:
+    for path, _ in chunks:
+        with np.load(path) as arrays:
+            yield ReviewBatch(arrays["card"], arrays["rating"], arrays["state"], arrays["elapsed_days"])
+
+
+def loss_and_gradient(w: np.ndarray, batch: ReviewBatch, decay: float = -0.5):
+    """Sum of the log losses of a batch's predictions, its gradient with respect to `w`, and the number of predictions."""
+    factor = 0.9 ** (1 / decay) - 1
+    eye = np.eye(NUM_WEIGHTS)
+    stability = np.ones(batch.cards)
+    difficulty = np.ones(batch.cards)
+    d_stability = np.zeros((batch.cards, NUM_WEIGHTS))
+    d_difficulty = np.zeros((batch.cards, NUM_WEIGHTS))
+
+    # Difficulty of an Easy first review, the target of the mean reversion
+    easy_raw = w[4] - np.exp(3 * w[5]) + 1
+    easy_difficulty = np.clip(easy_raw, 1, 10)
+    d_easy_difficulty = (eye[4] - 3 * np.exp(3 * w[5]) * eye[5]) * (1 < easy_raw < 10)
+
+    total = 0.0
+    gradient = np.zeros(NUM_WEIGHTS)
+    predictions = 0
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for rows in batch.steps:
+            card = batch.card[rows]
+            r = batch.rating[rows]
+            state = batch.state[rows]
+            t = batch.elapsed_days[rows]
+            s, d = stability[card], difficulty[card]
+            ds, dd = d_stability[card], d_difficulty[card]
+            new = state == NEW
+            short_term = (state == LEARNING) | (state == RELEARNING)
+            recall = (state == REVIEW) & (r > Rating.Again)
+            forget = (state == REVIEW) & (r == Rating.Again)
+
+            # Retrievability at the review and its gradient
+            base = 1 + factor * t / s
+            retrievability = base ** decay
+            d_retrievability = (decay * base ** (decay - 1) * -factor * t / s ** 2)[:, None] * ds
+
+            predicted = state == REVIEW
+            if predicted.any():
+                p = np.clip(retrievability[predicted], 1e-6, 1 - 1e-6)
+                y = (r[predicted] > Rating.Again).astype(np.float64)
+                total -= np.sum(y * np.log(p) + (1 - y) * np.log(1 - p))
+                gradient += ((p - y) / (p * (1 - p))) @ d_retrievability[predicted]
+                predictions += int(predicted.sum())
+
+            next_s = np.empty(len(rows))
+            next_ds = np.zeros((len(rows), NUM_WEIGHTS))
+
+            # First review: stability w[r-1], difficulty w4 - exp(w5 (r-1)) + 1
+            init_raw = w[4] - np.exp(w[5] * (r - 1)) + 1
+            init_d = np.clip(init_raw, 1, 10)
+            d_init_d = (eye[4] - ((r - 1) * np.exp(w[5] * (r - 1)))[:, None] * eye[5]) * ((1 < init_raw) & (init_raw < 10))[:, None]
+            next_s[new] = np.maximum(w[r[new] - 1], 0.1)
+            next_ds[new] = eye[r[new] - 1] * (w[r[new] - 1] > 0.1)[:, None]
+
+            # Later reviews: difficulty moves by w6 per rating step, reverting to the Easy difficulty by w7
+            moved = d - w[6] * (r - 3)
+            next_raw = w[7] * easy_difficulty + (1 - w[7]) * moved
+            d_moved = dd - (r - 3)[:, None] * eye[6]
+            d_next_d = (w[7] * d_easy_difficulty + (1 - w[7]) * d_moved + (easy_difficulty - moved)[:, None] * eye[7]) * ((1 < next_raw) & (next_raw < 10))[:, None]
+            next_d = np.where(new, init_d, np.clip(next_raw, 1, 10))
+            next_dd = np.where(new[:, None], d_init_d, d_next_d)
+
+            # Same-day reviews: s exp(w17 (r - 3 + w18))
+            if short_term.any():
+                exponent = r[short_term] - 3 + w[18]
+                growth = np.exp(w[17] * exponent)
+                s_short = s[short_term]
+                next_s[short_term] = s_short * growth
+                next_ds[short_term] = growth[:, None] * ds[short_term] + (s_short * growth * exponent)[:, None] * eye[17] + (s_short * growth * w[17])[:, None] * eye[18]
+
+            # Successful reviews: s (1 + e^w8 (11 - d) s^-w9 (e^((1-R) w10) - 1) penalty)
+            if recall.any():
+                rs, rd, rr = s[recall], d[recall], retrievability[recall]
+                rds, rdd, rdr = ds[recall], dd[recall], d_retrievability[recall]
+                hard = r[recall] == Rating.Hard
+                easy = r[recall] == Rating.Easy
+                penalty = np.where(hard, w[15], 1.0) * np.where(easy, w[16], 1.0)
+                growth = np.exp((1 - rr) * w[10])
+                scale = np.exp(w[8]) * (11 - rd) * rs ** -w[9] * penalty
+                d_scale = scale[:, None] * (
+                    eye[8]
+                    - rdd / (11 - rd)[:, None]
+                    - w[9] * rds / rs[:, None]
+                    - np.log(rs)[:, None] * eye[9]
+                    + (hard / w[15])[:, None] * eye[15]
+                    + (easy / w[16])[:, None] * eye[16]
+                )
+                increase = scale * (growth - 1)
+                d_increase = d_scale * (growth - 1)[:, None] + (scale * growth)[:, None] * (-w[10] * rdr + (1 - rr)[:, None] * eye[10])
+                next_s[recall] = rs * (1 + increase)
+                next_ds[recall] = rds * (1 + increase)[:, None] + rs[:, None] * d_increase
+
+            # Lapses: w11 d^-w12 ((s + 1)^w13 - 1) e^((1-R) w14)
+            if forget.any():
+                fs, fd, fr = s[forget], d[forget], retrievability[forget]
+                fds, fdd, fdr = ds[forget], dd[forget], d_retrievability[forget]
+                power_d = fd ** -w[12]
+                power_s = (fs + 1) ** w[13]
+                growth = np.exp((1 - fr) * w[14])
+                value = w[11] * power_d * (power_s - 1) * growth
+                next_s[forget] = value
+                next_ds[forget] = (
+                    (power_d * (power_s - 1) * growth)[:, None] * eye[11]
+                    + (w[11] * (power_s - 1) * growth)[:, None] * (-w[12] * (fd ** (-w[12] - 1)))[:, None] * fdd
+                    - (value * np.log(fd))[:, None] * eye[12]
+                    + (w[11] * power_d * growth)[:, None] * (w[13] * (fs + 1) ** (w[13] - 1))[:, None] * fds
+                    + (w[11] * power_d * growth * power_s * np.log(fs + 1))[:, None] * eye[13]
+                    + value[:, None] * (-w[14] * fdr + (1 - fr)[:, None] * eye[14])
+                )
+
+            floor = next_s < MIN_STABILITY
+            stability[card] = np.where(floor, MIN_STABILITY, next_s)
+            d_stability[card] = np.where(floor[:, None], 0.0, next_ds)
+            difficulty[card] = next_d
+            d_difficulty[card] = next_dd
+
+    return total, np.nan_to_num(gradient), predictions
+
+
+def evaluate(w: np.ndarray, chunks) -> Tuple[float, int, int]:
+    """The summed log loss of the spooled review log under weights `w`, the number of predictions and of reviews."""
+    total, predictions, reviews = 0.0, 0, 0
+    for chunk in load_review_batches(chunks):
+        loss, _, count = loss_and_gradient(w, chunk)
+        total += loss
+        predictions += count
+        reviews += len(chunk)
+    return total, predictions, reviews
+
+
+def fit_weights(db: Session, user_id: int, initial: Optional[Sequence[float]] = None, epochs: int = 5, chunk_rows: int = 200_000,
+                batch_cards: int = 512, learning_rate: float = 0.04) -> dict:
+    """Fits FSRS weights to a user's review_log with Adam, going over it `epochs` times.
+
+    The log is read from the database once and spooled to a temporary directory, a chunk
+    per file, so every epoch holds a single chunk in memory. Returns the weights, the mean
+    log loss of the initial and of the fitted weights, and the number of reviews and
+    predictions; "weights" is None when the history has fewer than MIN_PREDICTIONS
+    predictions to learn from.
+    """
+    start = time.perf_counter()
+    w = np.array(initial if initial is not None else FSRS().p.w, dtype=np.float64)
+    m = np.zeros(NUM_WEIGHTS)
+    v = np.zeros(NUM_WEIGHTS)
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+    step = 0
+    with tempfile.TemporaryDirectory(prefix="fsrs-optimizer-") as spool:
+        chunks = spool_review_batches(db, user_id, spool, chunk_rows)
+        # The loss of the initial weights, before any update
+        initial, predictions, reviews = evaluate(w, chunks)
+        if predictions < MIN_PREDICTIONS:
+            return {"weights": None, "reviews": reviews, "predictions": predictions, "seconds": time.perf_counter() - start}
+        total_steps = epochs * sum(-(-cards // batch_cards) for _, cards in chunks)
+        for epoch in range(epochs):
+            for chunk in load_review_batches(chunks):
+                for batch in chunk.split(batch_cards):
+                    _, gradient, count = loss_and_gradient(w, batch)
+                    if not count:
+                        continue
+                    step += 1
+                    gradient /= count
+                    m = beta1 * m + (1 - beta1) * gradient
+                    v = beta2 * v + (1 - beta2) * gradient ** 2
+                    m_hat = m / (1 - beta1 ** step)
+                    v_hat = v / (1 - beta2 ** step)
+                    # Cosine annealing: big steps first, settling down towards the end
+                    rate = learning_rate * 0.5 * (1 + math.cos(math.pi * step / total_steps))
+                    w = np.clip(w - rate * m_hat / (np.sqrt(v_hat) + epsilon), WEIGHT_BOUNDS[:, 0], WEIGHT_BOUNDS[:, 1])
+
+        final, _, _ = evaluate(w, chunks)
+    return {
+        "weights": [round(float(value), 4) for value in w],
+        "initial_loss": initial / predictions,
+        "loss": final / predictions,
+        "reviews": reviews,
+        "predictions": predictions,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def save_weights(db: Session, user_id: int, result: dict):
+    """Stores fitted weights in fsrs_params (the caller commits)."""
+    db.merge(models.FSRSParams(
+        user_id=user_id,
+        weights=result["weights"],
+        reviews=result["reviews"],
+        loss=result["loss"],
+        fitted_at=datetime.now(),
+    ))
+
+
+def optimize_user(db: Session, user_id: int, reschedule: bool = False, **options) -> dict:
+    """Fits, stores and (optionally) applies a user's weights to their whole deck."""
+    result = fit_weights(db, user_id, **options)
+    if result["weights"] is None:
+        return result
+    save_weights(db, user_id, result)
+    if reschedule:
+        from batch_scheduler import reschedule_user
+        result["rescheduled"] = reschedule_user(db, user_id, FSRS(w=tuple(result["weights"])))
+    db.commit()
+    return result
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    users = parser.add_mutually_exclusive_group(required=True)
+    users.add_argument("--user-id", type=int, action="append", help="user to optimize (repeatable)")
+    users.add_argument("--all", action="store_true", help="every user with a review log")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--chunk-rows", type=int, default=200_000, help="review_log rows held in memory at a time")
+    parser.add_argument("--reschedule", action="store_true", help="recompute the due dates of the user's deck with the new weights")
+    args = parser.parse_args(argv)
+
+    from db import SessionLocal
+    db = SessionLocal()
+    try:
+        user_ids = args.user_id or db.execute(select(models.ReviewLog.user_id).distinct()).scalars().all()
+        failed = 0
+        for user_id in user_ids:
+            try:
+                result = optimize_user(db, user_id, args.reschedule, epochs=args.epochs, chunk_rows=args.chunk_rows)
+            except Exception as error:
+                # One user's history must not stop the others from being fitted
+                db.rollback()
+                failed += 1
+                print(f"user {user_id}: failed: {error!r}", file=sys.stderr)
+                continue
+            if result["weights"] is None:
+                print(f"user {user_id}: {result['predictions']} predictions in {result['reviews']} reviews, too few to fit; skipped")
+                continue
+            print(f"user {user_id}: {result['reviews']} reviews, log loss {result['initial_loss']:.4f} -> {result['loss']:.4f} in {result['seconds']:.1f} s")
+    finally:
+        db.close()
+    if failed:
+        sys.exit(f"{failed} of {len(user_ids)} users failed")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,63 @@
+import base64
+import json
+
+from typing import Optional
+
+from fastapi import HTTPException, Response, status
+
+# Keyset (cursor) pagination helpers. A page is "the next `limit` rows with an id
+# greater than the last one seen", which MySQL answers straight from the primary key
+# index, so deep pages cost the same as the first one (unlike OFFSET, which scans
+# and throws away every skipped row).
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(last_id: int) -> str:
+    """Turns the id of the last row of a page into an opaque cursor for the next page."""
+    return base64.urlsafe_b64encode(json.dumps({"after_id": last_id}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """Returns the id a cursor made by encode_cursor points after."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(payload["after_id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def keyset_page(query, id_column, after_id: int, limit: int):
+    """
+    Returns the `limit` rows of `query` after `after_id` in id order, and the cursor
+    of the next page (None on the last page).
+    """
+    rows = query.filter(id_column > after_id).order_by(id_column).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1].id)
+    return rows, None
+
+
+def paginate(query, id_column, response: Response, skip: int, limit: int, after_id: Optional[int], cursor: Optional[str]):
+    """
+    Returns one page of `query` in id order and sets the X-Next-Cursor header when there
+    are more rows. A cursor or after_id selects the keyset page; otherwise skip is used
+    as an OFFSET, for clients that have not moved to cursors yet.
+    """
+    if cursor is not None:
+        after_id = decode_cursor(cursor)
+    if after_id is None and skip:
+        rows = query.order_by(id_column).offset(skip).limit(limit).all()
+        next_cursor = encode_cursor(rows[-1].id) if len(rows) == limit else None
+    else:
+        rows, next_cursor = keyset_page(query, id_column, after_id or 0, limit)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return rows
+
+
+def next_cursor_header(response: Response) -> dict:
+    """The X-Next-Cursor header set on `response`, for copying onto a response returned directly."""
+    if NEXT_CURSOR_HEADER in response.headers:
+        return {NEXT_CURSOR_HEADER: response.headers[NEXT_CURSOR_HEADER]}
+    return {}
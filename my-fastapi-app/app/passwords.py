@@ -0,0 +1,97 @@
+"""
+Password hashing off the event loop.
+
+bcrypt takes a few hundred milliseconds of CPU per hash or verify, and login and register are
+async routes: run inline, one login stalls every other request on the worker. `password_hasher`
+runs them on a small thread pool instead (bcrypt releases the GIL while it hashes) and awaits the
+result. PASSWORD_HASH_WORKERS caps how many run at once (default: the number of CPUs) and
+PASSWORD_HASH_MAX_QUEUE how many may wait for a worker (0 = no limit); beyond that a request is
+refused with 503 instead of queueing for seconds. Queue depth, waits and hash times are reported
+by stats() (GET /metrics).
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+
+
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '0')) or os.cpu_count() or 1
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv('PASSWORD_HASH_MAX_QUEUE', '0'))
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords with a CryptContext on a bounded thread pool."""
+
+    def __init__(self, context: CryptContext, workers: int, max_queue: int = 0):
+        self.context = context
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.work_total = 0.0
+        self.work_max = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password-hash")
+
+    def _call(self, submitted: float, function, *args):
+        start = time.perf_counter()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_total += start - submitted
+            self.wait_max = max(self.wait_max, start - submitted)
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.work_total += elapsed
+                self.work_max = max(self.work_max, elapsed)
+
+    async def _submit(self, function, *args):
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many logins in progress, try again shortly.",
+                                    headers={"Retry-After": "1"})
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, time.perf_counter(), function, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._submit(self.context.verify, password, hashed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "running": self.running,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_mean_ms": self.wait_total / (self.completed + self.running) * 1e3 if self.completed + self.running else 0.0,
+                "wait_max_ms": self.wait_max * 1e3,
+                "hash_mean_ms": self.work_total / self.completed * 1e3 if self.completed else 0.0,
+                "hash_max_ms": self.work_max * 1e3,
+            }
+
+
+bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto') # bcrypt hashing algorithm
+password_hasher = PasswordHasher(bcrypt_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
@@ -0,0 +1,182 @@
+"""
+Append-only review history.
+
+Review endpoints hand their review_log rows to `review_log_writer`, which only appends them to
+an in-memory buffer. A background thread writes the buffer with one multi-row INSERT once
+it holds `batch_size` rows or its oldest row is `max_delay` seconds old, so logging adds no
+INSERT to the request. close() (called on application shutdown and at interpreter exit)
+writes whatever is still buffered. When the database rejects a batch (e.g. a row for a deleted
+flashcard), the batch is split in halves and retried until the offending rows are isolated;
+only those are dropped, logged and counted as rejected. When the connection or server fails,
+the unwritten rows are kept and retried on the next flush, up to `max_buffered` rows; beyond
+that the oldest are dropped and counted.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import timezone
+from typing import Iterable, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError
+
+import models
+from db import engine
+
+
+logger = logging.getLogger(__name__)
+
+
+def review_log_row(user_id: int, flashcard_id: int, review_log) -> dict:
+    """The review_log row of an fsrs ReviewLog (from FSRS.repeat(card, now)[rating].review_log)."""
+    return {
+        "user_id": user_id,
+        "flashcard_id": flashcard_id,
+        "rating": int(review_log.rating),
+        "state": review_log.state.name,
+        "elapsed_days": review_log.elapsed_days,
+        "scheduled_days": review_log.scheduled_days,
+        "review": review_log.review.astimezone(timezone.utc).replace(tzinfo=None),
+    }
+
+
+def connection_error(error: Exception) -> bool:
+    """Whether a write failed because of the connection or the server rather than the rows written."""
+    return isinstance(error, (OperationalError, InterfaceError, DisconnectionError)) or getattr(error, "connection_invalidated", False)
+
+
+class ReviewLogWriter:
+    """Buffers review_log rows and inserts them in batches from a background thread."""
+
+    def __init__(self, engine, batch_size: int = 500, max_delay: float = 1.0, max_buffered: int = 100_000):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._buffer: List[dict] = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _start(self):
+        # Called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="review-log-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def log(self, rows: Iterable[dict]):
+        """Queues review_log rows; returns without touching the database."""
+        rows = list(rows)
+        if not rows:
+            return
+        with self._lock:
+            if not self._closed:
+                if not self._buffer:
+                    self._oldest = time.monotonic()
+                self._buffer.extend(rows)
+                self._start()
+                if len(self._buffer) >= self.batch_size:
+                    self._wakeup.set()
+                return
+        # Nobody is left to flush them, so write them now; there is no later flush to retry them
+        unwritten = self._insert(rows)
+        if unwritten:
+            with self._lock:
+                self.dropped += len(unwritten)
+            logger.error("Dropped %d review log rows that could not be written after close", len(unwritten))
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.max_delay)
+            self._wakeup.clear()
+            with self._lock:
+                due = self._buffer and (len(self._buffer) >= self.batch_size or time.monotonic() - self._oldest >= self.max_delay)
+            if due:
+                self.flush()
+
+    def _write(self, rows: List[dict]) -> List[dict]:
+        """Inserts rows in one transaction, splitting them in halves while the database rejects them.
+
+        Returns the rows left unwritten by a connection error, to be retried.
+        """
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(insert(models.ReviewLog).values(rows))
+        except Exception as error:
+            if connection_error(error):
+                self.failures += 1
+                logger.exception("Could not write %d review log rows, will retry", len(rows))
+                return rows
+            if len(rows) == 1:
+                self.rejected += 1
+                logger.error("Dropped a review log row the database rejected: %r (%s)", rows[0], error)
+                return []
+            middle = len(rows) // 2
+            unwritten = self._write(rows[:middle])
+            if unwritten:
+                return unwritten + rows[middle:]
+            return self._write(rows[middle:])
+        self.written += len(rows)
+        return []
+
+    def _insert(self, rows: List[dict]) -> List[dict]:
+        """Writes rows in batches of `batch_size`; returns those left unwritten by a connection error."""
+        for start in range(0, len(rows), self.batch_size):
+            unwritten = self._write(rows[start:start + self.batch_size])
+            if unwritten:
+                return unwritten + rows[start + self.batch_size:]
+        self.flushes += 1
+        return []
+
+    def flush(self):
+        """Writes everything buffered so far; rows left unwritten go back to the front of the buffer."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return
+            rows = self._insert(rows)
+            if not rows:
+                return
+            with self._lock:
+                self._buffer[:0] = rows
+                overflow = len(self._buffer) - self.max_buffered
+                if overflow > 0:
+                    del self._buffer[:overflow]
+                    self.dropped += overflow
+                    logger.error("Dropped %d review log rows after repeated write failures", overflow)
+                self._oldest = time.monotonic()
+
+    def close(self):
+        """Stops the background thread and writes what is left. Safe to call more than once."""
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wakeup.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "buffered": len(self._buffer),
+                "written": self.written,
+                "flushes": self.flushes,
+                "failures": self.failures,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+            }
+
+
+review_log_writer = ReviewLogWriter(engine)
@@ -0,0 +1,164 @@
+"""
+In-memory review queues of recently active users.
+
+The first request of a user loads (flashcard_id, due) of their whole schedule into a min-heap
+ordered by due, plus a cursor: the highest flashcard id they have scheduled, so the next new
+card is the next id of the catalog (FlashcardCatalog.next_id). Listing the due cards then pops
+the heap instead of querying the (user_id, due) index, and adding a new card needs no query.
+
+Routes that write CardSchedule report the new due dates after they commit (reviewed / added),
+or drop the user's queue when the dates are computed in SQL or an insert lost a race on the
+unique (user_id, flashcard_id) constraint (invalidate). A review pushes a new heap entry; the
+old one is skipped when popped. Queues are reloaded after `ttl` seconds, to pick up writes from
+other processes, and evicted after `idle` seconds without use or when more than `max_users` are
+held.
+"""
+import heapq
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import models
+from cache import LRUCache, flashcard_catalog
+from crud import due_cutoff
+
+
+class UserQueue:
+    """One user's schedule: a heap of (due, flashcard_id), the current due of each card and the new-card cursor."""
+
+    def __init__(self, schedules: Iterable[Tuple[int, Optional[datetime]]]):
+        self.due: Dict[int, Optional[datetime]] = {}
+        self.last_flashcard_id = 0
+        for flashcard_id, due in schedules:
+            self.due[flashcard_id] = due
+            self.last_flashcard_id = max(self.last_flashcard_id, flashcard_id)
+        self.heap = [(due, flashcard_id) for flashcard_id, due in self.due.items() if due is not None]
+        heapq.heapify(self.heap)
+        self.lock = threading.Lock()
+        self.loaded = time.monotonic()
+
+    def update(self, flashcard_id: int, due: Optional[datetime]):
+        # Called with the lock held
+        self.last_flashcard_id = max(self.last_flashcard_id, flashcard_id)
+        if flashcard_id in self.due and self.due[flashcard_id] == due:
+            return
+        self.due[flashcard_id] = due
+        if due is not None:
+            heapq.heappush(self.heap, (due, flashcard_id))
+        if len(self.heap) > 2 * len(self.due) + 64:
+            # Mostly outdated entries: rebuild from the current due dates
+            self.heap = [(due, flashcard_id) for flashcard_id, due in self.due.items() if due is not None]
+            heapq.heapify(self.heap)
+
+    def due_ids(self, cutoff: datetime, limit: int) -> List[int]:
+        """The ids of up to `limit` cards due before `cutoff`, soonest first. Called with the lock held."""
+        taken = []
+        while self.heap and len(taken) < limit:
+            due, flashcard_id = self.heap[0]
+            if self.due.get(flashcard_id) != due:
+                heapq.heappop(self.heap)
+                continue
+            if due >= cutoff:
+                break
+            taken.append(heapq.heappop(self.heap))
+        for entry in taken:
+            heapq.heappush(self.heap, entry)
+        return [flashcard_id for _, flashcard_id in taken]
+
+
+class ReviewQueues:
+    """The review queues of recently active users, loaded lazily and evicted when idle."""
+
+    def __init__(self, max_users: int = 1_000, ttl: float = 300.0, idle: float = 600.0):
+        self.queues = LRUCache(max_users)
+        self.ttl = ttl
+        self.idle = idle
+        self.loads = 0
+        self.idle_evictions = 0
+        # When each user's schedule was last written, to not keep a queue loaded before that
+        self._written = LRUCache(4 * max_users)
+        self._lock = threading.Lock()
+
+    def _evict_idle(self, now: float):
+        # Called with the lock held; the least recently used queues come first
+        while True:
+            oldest = self.queues.oldest()
+            if oldest is None or now - oldest[1][0] < self.idle:
+                return
+            self.queues.pop(oldest[0])
+            self.idle_evictions += 1
+
+    def get(self, db: Session, user_id: int) -> UserQueue:
+        """The user's queue, loaded from CardSchedule if it is not held or older than `ttl`."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self.queues.get(user_id)
+            if entry is not None and now - entry[1].loaded < self.ttl:
+                self.queues.put(user_id, (now, entry[1]))
+                return entry[1]
+        rows = db.query(models.CardSchedule.flashcard_id, models.CardSchedule.due).filter(models.CardSchedule.user_id == user_id).all()
+        queue = UserQueue(rows)
+        with self._lock:
+            self.loads += 1
+            written = self._written.pop(user_id)
+            if written is None or written < now:
+                self.queues.put(user_id, (now, queue))
+            else:
+                # Written while loading: use this queue once, load again next time
+                self._written.put(user_id, written)
+        return queue
+
+    def _held(self, user_id: int) -> Optional[UserQueue]:
+        with self._lock:
+            self._written.put(user_id, time.monotonic())
+            entry = self.queues.get(user_id)
+        return entry[1] if entry is not None else None
+
+    def due_ids(self, db: Session, user_id: int, limit: int, now: datetime = None) -> List[int]:
+        """Like crud.get_due_flashcard_ids, from the user's queue."""
+        queue = self.get(db, user_id)
+        with queue.lock:
+            return queue.due_ids(due_cutoff(now), limit)
+
+    def next_new_flashcard_id(self, db: Session, user_id: int) -> Optional[int]:
+        """The id of the next flashcard the user has not scheduled, or None when none is left.
+
+        The cursor only moves in added(), once the schedule is committed: a failed insert does not
+        skip a card. Concurrent requests may get the same id; the unique (user_id, flashcard_id)
+        constraint rejects all but one, and the others invalidate() and ask again.
+        """
+        queue = self.get(db, user_id)
+        with queue.lock:
+            return flashcard_catalog.next_id(db, queue.last_flashcard_id)
+
+    def reviewed(self, user_id: int, dues: Dict[int, Optional[datetime]]):
+        """Records the committed due dates of some of a user's cards (if their queue is held)."""
+        queue = self._held(user_id)
+        if queue is None:
+            return
+        with queue.lock:
+            for flashcard_id, due in dues.items():
+                queue.update(flashcard_id, due)
+
+    def added(self, user_id: int, flashcard_id: int, due: Optional[datetime]):
+        self.reviewed(user_id, {flashcard_id: due})
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Drops the queue of a user (e.g. after an UPDATE that computed due dates in SQL), or of everyone."""
+        with self._lock:
+            if user_id is None:
+                self.queues.clear()
+            else:
+                self._written.put(user_id, time.monotonic())
+                self.queues.pop(user_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.queues.stats(), "loads": self.loads, "idle_evictions": self.idle_evictions}
+
+
+review_queues = ReviewQueues()
@@ -1,47 +1,138 @@
 # FILE: router.py
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
-from typing import List, Annotated
+from typing import Dict, List, Optional, Annotated
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from auth import get_current_user, create_user, login_for_access_token, authenticate_user, create_access_token
-from schemas import FlashcardBase, UserBase, CreateUserRequest, Token, CardSchedule #FlashcardRating
-from db import get_db
+from auth import get_current_user, get_current_user_record, create_user, login_for_access_token, authenticate_user, create_access_token, token_cache, user_cache
+from schemas import FlashcardBase, FlashcardType, UserBase, UserProfile, CreateUserRequest, Token, CardSchedule #FlashcardRating
+from db import get_db, get_async_db, execute, commit, refresh, pool_stats
+from pagination import NEXT_CURSOR_HEADER, encode_cursor, decode_cursor, next_cursor_header, paginate
+from cache import flashcard_catalog
+from crud import introduce_flashcards, shift_due
+from scheduler import SCHEDULE_FIELDS, parse_rating, to_fsrs_card, schedule_values, scheduler_service
+from batch_scheduler import reschedule_user
+from review_log import review_log_row, review_log_writer
+from passwords import password_hasher
+from review_queue import review_queues
+from fast_json import FLASHCARD_COLUMNS, FLASHCARD_NAMES, flashcard_rows, rows_response
+from http_cache import cache_headers, etag_matches, make_etag, not_modified
 import models as models
 
 # Create separate routers for auth and main routes
 auth_router = APIRouter(prefix="/auth", tags=["auth"])
 main_router = APIRouter(prefix="/main", tags=["main"])
+metrics_router = APIRouter(tags=["metrics"])
 
 db_dependency = Annotated[Session, Depends(get_db)]
+# For async routes: an AsyncSession, or a Session used through db.execute/commit/refresh
+async_db_dependency = Annotated[Session, Depends(get_async_db)]
 user_dependency = Annotated [dict, Depends (get_current_user)]
 
 # Register endpoint
 @auth_router.post("/register", status_code=status.HTTP_201_CREATED)
-async def register_user(db: db_dependency, create_user_request: CreateUserRequest):
+async def register_user(db: async_db_dependency, create_user_request: CreateUserRequest):
     return await create_user(db, create_user_request)
 
 # Log in endpoint
 @auth_router.post("/token", response_model=Token)
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: db_dependency):
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: async_db_dependency):
     return await login_for_access_token(form_data, db)
 
+# Current user endpoint: the user's own row, without the password hash
+@auth_router.get("/me", response_model=UserProfile)
+async def read_current_user(user: Annotated[UserBase, Depends(get_current_user_record)]):
+    return user
+
 
 
 # Get all flashcards endpoint
+'''Pages through the flashcards in id order. Pass the X-Next-Cursor header of a response as
+?cursor= (or the last id seen as ?after_id=) to get the next page from the primary key index;
+skip still works but gets slower the deeper the page. level and type narrow the results
+(send them again with the cursor). ?fast=true returns the same page through the orjson fast path.
+Pages carry an ETag from the catalog version: send it back as If-None-Match to get a 304 until
+the next import.'''
 @main_router.get("/flashcards", response_model=List[FlashcardBase])
-def read_flashcards(skip: int = 0, limit: int = 10, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    flashcards = db.query(models.Flashcard).offset(skip).limit(limit).all()
+def read_flashcards(response: Response, skip: int = 0, limit: int = Query(10, ge=1, le=1000), after_id: Optional[int] = None, cursor: Optional[str] = None,
+                    level: Optional[int] = None, flashcard_type: Optional[FlashcardType] = Query(None, alias="type"), fast: bool = False,
+                    if_none_match: Optional[str] = Header(None),
+                    db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    etag = make_etag(flashcard_catalog.current_version(db), skip, limit, after_id, cursor, level, flashcard_type, fast)
+    headers = cache_headers(etag)
+    if etag_matches(if_none_match, etag):
+        return not_modified(headers)
+    response.headers.update(headers)
+
+    query = db.query(*FLASHCARD_COLUMNS) if fast else db.query(models.Flashcard)
+    if level is not None:
+        query = query.filter(models.Flashcard.level == level)
+    if flashcard_type is not None:
+        query = query.filter(models.Flashcard.type == models.FlashcardType(flashcard_type.value))
+    if level is not None and flashcard_type is not None and not skip:
+        # A whole (level, type) group is small enough to be served from the catalog cache
+        flashcards, has_more = flashcard_catalog.page_group(db, level, flashcard_type.value, decode_cursor(cursor) if cursor else after_id or 0, limit)
+        if has_more:
+            response.headers[NEXT_CURSOR_HEADER] = encode_cursor(flashcards[-1].id)
+        if fast:
+            return rows_response(flashcard_rows(flashcards), FLASHCARD_NAMES, {**headers, **next_cursor_header(response)})
+        return flashcards
+    flashcards = paginate(query, models.Flashcard.id, response, skip, limit, after_id, cursor)
+    if fast:
+        return rows_response(flashcards, headers={**headers, **next_cursor_header(response)})
     return flashcards
 
-# Get all users endpoint
+# Get the fields of a flashcard endpoint
+@main_router.get("/flashcards/{flashcard_id}/fields", response_model=Dict[str, str])
+def read_flashcard_fields(flashcard_id: int, name: Optional[List[str]] = Query(None), db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    """Returns the note fields of a flashcard by name, or only the ones asked for with ?name=Meaning&name=Reading."""
+    flashcard = db.query(models.Flashcard.field_values).filter(models.Flashcard.id == flashcard_id).first()
+    if flashcard is None:
+        raise HTTPException(status_code=404, detail="Flashcard not found")
+    field_values = flashcard.field_values or {}
+    if name:
+        return {key: field_values[key] for key in name if key in field_values}
+    return field_values
+
+# Get all users endpoint (same paging as /flashcards)
 @main_router.get("/users", response_model=List[UserBase])
-def read_users(skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
-    users = db.query(models.User).offset(skip).limit(limit).all()
-    return users
+def read_users(response: Response, skip: int = 0, limit: int = Query(10, ge=1, le=1000), after_id: Optional[int] = None, cursor: Optional[str] = None,
+               db: Session = Depends(get_db)):
+    return paginate(db.query(models.User), models.User.id, response, skip, limit, after_id, cursor)
+
+# Flashcard catalog cache statistics endpoint (for operators)
+@main_router.get("/catalog/cache", status_code=status.HTTP_200_OK)
+def read_catalog_cache_stats(current_user: dict = Depends(get_current_user)):
+    return flashcard_catalog.stats()
+
+# FSRS scheduler cache and timing statistics endpoint (for operators)
+@main_router.get("/scheduler/stats", status_code=status.HTTP_200_OK)
+def read_scheduler_stats(current_user: dict = Depends(get_current_user)):
+    return scheduler_service.stats()
+
+# Review queue cache statistics endpoint (for operators)
+@main_router.get("/review_queue/stats", status_code=status.HTTP_200_OK)
+def read_review_queue_stats(current_user: dict = Depends(get_current_user)):
+    return review_queues.stats()
+
+# Review log writer statistics endpoint (for operators)
+@main_router.get("/review_log/stats", status_code=status.HTTP_200_OK)
+def read_review_log_stats(current_user: dict = Depends(get_current_user)):
+    return review_log_writer.stats()
+
+# Operational metrics endpoint, for scrapers: no token needed and only counters in the response
+'''Connection pool metrics: connections in use, idle and in overflow, how long checkouts waited,
+how many timed out, and how many connections were opened, invalidated and closed. Also the
+password hashing pool: queue depth, waits, hash times and refused requests. And the hit rates
+of the verified-token and user caches.'''
+@metrics_router.get("/metrics", status_code=status.HTTP_200_OK)
+def read_metrics():
+    return {**pool_stats(), "password_hashing": password_hasher.stats(), "token_cache": token_cache.stats(), "user_cache": user_cache.stats()}
 
 @main_router.get("/", status_code=status.HTTP_200_OK)
-async def user(user: user_dependency, db: db_dependency):
+async def user(user: user_dependency):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
     return {"User": user}
@@ -52,82 +143,114 @@ if it doesnt, add the first flashcard from the flashcard table (order based on f
 if the user does have a flashcard in their Cardschedule then add the subsequent flashcard '''
 
 from fastapi import HTTPException
+from fsrs import State
 from sqlalchemy.orm.exc import NoResultFound
 
+def insert_next_flashcard(db: Session, user_id: int, attempts: int = 3) -> models.CardSchedule:
+    """
+    Adds the flashcard after the last one in the user's CardSchedule (the first one if there is
+    none), found from the user's review queue and the catalog's id list, and commits. If another
+    request or worker added that card first, the unique (user_id, flashcard_id) constraint
+    rejects the row: the user's queue is reloaded and the next card is tried.
+    """
+    for _ in range(attempts):
+        flashcard_to_add = review_queues.next_new_flashcard_id(db, user_id)
+        if flashcard_to_add is None:
+            raise HTTPException(status_code=400, detail="No more flashcards to add")
+
+        new_schedule = models.CardSchedule(
+            flashcard_id=flashcard_to_add,
+            user_id=user_id,
+            stability=0.0,
+            difficulty=0.0,
+            elapsed_days=0,
+            scheduled_days=0,
+            reps=0,
+            lapses=0,
+            state=State.New.name
+        )
+        db.add(new_schedule)
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            review_queues.invalidate(user_id)
+            continue
+        db.refresh(new_schedule)
+        review_queues.added(user_id, new_schedule.flashcard_id, new_schedule.due)
+        return new_schedule
+    raise HTTPException(status_code=409, detail="The schedule changed while adding a flashcard, try again")
+
 @main_router.post("/cardschedule/add_flashcard", response_model=CardSchedule)
 def add_flashcard_to_schedule(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    # Check if the user has any flashcards in their CardSchedule
-    try:
-        last_flashcard = db.query(models.CardSchedule).filter(models.CardSchedule.user_id == current_user['id']).order_by(models.CardSchedule.flashcard_id.desc()).first()
-    except NoResultFound:
-        last_flashcard = None
+    # Add the flashcard to the user's CardSchedule
+    return insert_next_flashcard(db, current_user['id'])
 
-    # If the user has no flashcards in their CardSchedule, add the first flashcard from the Flashcard table
-    if last_flashcard is None:
-        flashcard_to_add = db.query(models.Flashcard).order_by(models.Flashcard.id).first()
-    # If the user has flashcards in their CardSchedule, add the subsequent flashcard
-    else:
-        flashcard_to_add = db.query(models.Flashcard).filter(models.Flashcard.id > last_flashcard.flashcard_id).order_by(models.Flashcard.id).first()
 
-    if flashcard_to_add is None:
-        raise HTTPException(status_code=400, detail="No more flashcards to add")
 
-    # Add the flashcard to the user's CardSchedule
-    new_schedule = models.CardSchedule(
-        flashcard_id=flashcard_to_add.id,
-        user_id=current_user['id'],
-        stability=0.0,
-        difficulty=0.0,
-        elapsed_days=0,
-        scheduled_days=0,
-        reps=0,
-        lapses=0,
-        state='new'
-    )
-    db.add(new_schedule)
-    db.commit()
-    db.refresh(new_schedule)
-    return new_schedule
+# Cardschedule endpoint:
+'''Adds the next `count` flashcards the user has not scheduled yet (in id order, optionally only of one
+level and type, e.g. a whole level's kanji at once) as New cards with a single INSERT ... SELECT,
+and returns the created schedules.'''
+@main_router.post("/cardschedule/introduce", response_model=List[CardSchedule])
+def introduce_flashcards_to_schedule(count: int = Query(10, ge=1, le=1000), level: Optional[int] = None,
+                                     flashcard_type: Optional[FlashcardType] = Query(None, alias="type"),
+                                     db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    for _ in range(3):
+        schedules = introduce_flashcards(db, current_user['id'], count, level, flashcard_type.value if flashcard_type is not None else None)
+        if not schedules:
+            db.rollback()
+            raise HTTPException(status_code=400, detail="No more flashcards to add")
+        try:
+            db.commit()
+            break
+        except IntegrityError:
+            # A concurrent add took one of the cards first (unique user_id, flashcard_id): pick again
+            db.rollback()
+            review_queues.invalidate(current_user['id'])
+    else:
+        raise HTTPException(status_code=409, detail="The schedule changed while adding flashcards, try again")
+    review_queues.reviewed(current_user['id'], {schedule.flashcard_id: schedule.due for schedule in schedules})
+    return schedules
 
 
 
 # Cardschedule enpoint
 ''' 
 This endpoint will first check if the user has any flashcards due down to the minute in their CardSchedule. 
-If they don't have any due, it will inform the client.
+If they don't have any due, it will inform the client. At most `limit` cards are returned, soonest due first,
+from the user's in-memory review queue (see review_queue.py). ?fast=true encodes the cached cards with orjson
+instead of validating them against the response model (see fast_json.py).
 '''
 from fastapi import HTTPException
-from sqlalchemy import func
 from typing import List
 
 @main_router.get("/cardschedule/due_flashcards", response_model=List[FlashcardBase])
-def get_due_flashcards(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    current_time = func.now()
-    truncated_current_time = func.date_format(current_time, '%Y-%m-%d %H:%i:00')
-    due_flashcards = db.query(models.CardSchedule, models.Flashcard).join(models.Flashcard, models.CardSchedule.flashcard_id == models.Flashcard.id).filter(models.CardSchedule.user_id == current_user['id'], func.date_format(models.CardSchedule.due, '%Y-%m-%d %H:%i:00') <= truncated_current_time).all()
+def get_due_flashcards(limit: int = Query(100, ge=1, le=1000), fast: bool = False, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    due_ids = review_queues.due_ids(db, current_user['id'], limit)
 
-    if not due_flashcards:
+    if not due_ids:
         raise HTTPException(status_code=404, detail="No flashcards due")
 
-    return [flashcard for _, flashcard in due_flashcards]
+    # The cards themselves come from the catalog cache instead of a join
+    flashcards = flashcard_catalog.get_many(db, due_ids)
+    if fast:
+        return rows_response(flashcard_rows(flashcards[flashcard_id] for flashcard_id in due_ids if flashcard_id in flashcards), FLASHCARD_NAMES)
+    return [flashcards[flashcard_id] for flashcard_id in due_ids if flashcard_id in flashcards]
 
 
 # Cardschedule endpoint:
 '''
 Make an endpoint called “scheduleUpdate” that takes as input one or more flashcard ids. 
-Then it will add 5 minutes to the due date of the flashcard on the cardschedule for the user
+Then it will add 5 minutes (or ?minutes=) to the due date of the flashcard on the cardschedule for the user,
+with a single UPDATE, and report the ids that are not in the user's schedule.
 '''
-from datetime import timedelta
-
 @main_router.put("/scheduleUpdate/")
-def update_schedule(flashcard_ids: List[int], db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    for flashcard_id in flashcard_ids:
-        db_cardschedule = db.query(models.CardSchedule).filter(models.CardSchedule.flashcard_id == flashcard_id,models.CardSchedule.user_id == current_user['id']).first()
-        if not db_cardschedule:
-            raise HTTPException(status_code=404, detail=f"CardSchedule for flashcard_id {flashcard_id} not found")
-        db_cardschedule.due += timedelta(minutes=5)
+def update_schedule(flashcard_ids: List[int], minutes: int = 5, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    not_found = shift_due(db, current_user['id'], flashcard_ids, minutes)
     db.commit()
-    return {"message": "Schedule updated successfully"}
+    review_queues.invalidate(current_user['id'])
+    return {"message": "Schedule updated successfully", "not_found": not_found}
 
 
 ## FSRS schedule endpoint
@@ -194,65 +317,16 @@ from datetime import datetime, timezone
 
 @main_router.post("/cardschedule/new_add_flashcard", response_model=CardSchedule)
 def new_add_flashcard_to_schedule(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    # Check if the user has any flashcards in their CardSchedule
-    try:
-        last_flashcard = db.query(models.CardSchedule).filter(models.CardSchedule.user_id == current_user['id']).order_by(models.CardSchedule.flashcard_id.desc()).first()
-    except NoResultFound:
-        last_flashcard = None
-
-    # If the user has no flashcards in their CardSchedule, add the first flashcard from the Flashcard table
-    if last_flashcard is None:
-        flashcard_to_add = db.query(models.Flashcard).order_by(models.Flashcard.id).first()
-    # If the user has flashcards in their CardSchedule, add the subsequent flashcard
-    else:
-        flashcard_to_add = db.query(models.Flashcard).filter(models.Flashcard.id > last_flashcard.flashcard_id).order_by(models.Flashcard.id).first()
-
-    if flashcard_to_add is None:
-        raise HTTPException(status_code=400, detail="No more flashcards to add")
-
     # Add the flashcard to the user's CardSchedule
-    new_schedule = models.CardSchedule(
-        flashcard_id=flashcard_to_add.id,
-        user_id=current_user['id'],
-        stability=0.0,
-        difficulty=0.0,
-        elapsed_days=0,
-        scheduled_days=0,
-        reps=0,
-        lapses=0,
-        state='new'
-    )
-    db.add(new_schedule)
-    db.commit()
-    db.refresh(new_schedule)
+    new_schedule = insert_next_flashcard(db, current_user['id'])
 
-    # Create FSRS Card object from database data
-    card = Card(
-        due=new_schedule.due,
-        stability=new_schedule.stability,
-        difficulty=new_schedule.difficulty,
-        elapsed_days=new_schedule.elapsed_days,
-        scheduled_days=new_schedule.scheduled_days,
-        reps=new_schedule.reps,
-        lapses=new_schedule.lapses,
-        state=new_schedule.state,
-        last_review=new_schedule.last_review
-    )
-
-    # Convert Card object back to dictionary and update the database
-    card_dict = card.to_dict()
-    new_schedule.due = card_dict["due"]
-    new_schedule.stability = card_dict["stability"]
-    new_schedule.difficulty = card_dict["difficulty"]
-    new_schedule.elapsed_days = card_dict["elapsed_days"]
-    new_schedule.scheduled_days = card_dict["scheduled_days"]
-    new_schedule.reps = card_dict["reps"]
-    new_schedule.lapses = card_dict["lapses"]
-    new_schedule.state = card_dict["state"]
-    new_schedule.last_review = card_dict["last_review"]
+    # Round-trip through an FSRS Card so the row holds what fsrs would store
+    for name, value in schedule_values(to_fsrs_card(new_schedule)).items():
+        setattr(new_schedule, name, value)
 
     db.commit()
     db.refresh(new_schedule)
+    review_queues.added(current_user['id'], new_schedule.flashcard_id, new_schedule.due)
 
     return new_schedule
 
@@ -305,22 +379,10 @@ def fsrs_update_schedule(
                 detail=f"No matching flashcard schedule found for flashcard ID {rating.flashcard_id}"
             )
 
-        fsrs = FSRS()
+        fsrs = scheduler_service.get(db, user_id)
         review_time = datetime.now(timezone.utc)
 
-        card_data = {
-            "due": schedule.due.isoformat(),
-            "stability": schedule.stability,
-            "difficulty": schedule.difficulty,
-            "elapsed_days": schedule.elapsed_days,
-            "scheduled_days": schedule.scheduled_days,
-            "reps": schedule.reps,
-            "lapses": schedule.lapses,
-            "state": schedule.state,
-            "last_review": schedule.last_review.isoformat() if schedule.last_review else None
-        }
-
-        card = Card.from_dict(card_data)
+        card = to_fsrs_card(schedule)
         if not isinstance(card, Card):
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to instantiate Card object from fsrs library"
         )
@@ -359,29 +421,77 @@ def fsrs_update_schedule(
         )
 
 
+# Batch FSRS review endpoint
+'''
+Takes the ratings of a whole review session at once: the schedules are loaded with one IN query,
+rescheduled with FSRS in memory and written back with one bulk UPDATE in a single transaction.
+If any flashcard is not in the user's schedule nothing is updated.
+'''
+@main_router.put("/scheduleUpdateFSRS/batch", response_model=List[CardSchedule])
+def fsrs_batch_update_schedule(ratings: List[FlashcardRating], db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    user_id = current_user['id']
+    try:
+        parsed_ratings = [(rating.flashcard_id, parse_rating(rating.rating)) for rating in ratings]
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ratings must be Again, Hard, Good, Easy or 1-4")
+
+    flashcard_ids = {flashcard_id for flashcard_id, _ in parsed_ratings}
+    columns = [getattr(models.CardSchedule, name) for name in ("id", "flashcard_id") + SCHEDULE_FIELDS]
+    schedules = {row.flashcard_id: row for row in db.query(*columns).filter(
+        models.CardSchedule.user_id == user_id,
+        models.CardSchedule.flashcard_id.in_(flashcard_ids),
+    ).all()}
+    missing = sorted(flashcard_ids - schedules.keys())
+    if missing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No matching flashcard schedule found for flashcard IDs {missing}")
+
+    fsrs = scheduler_service.get(db, user_id)
+    review_time = datetime.now(timezone.utc)
+    with scheduler_service.timer("convert"):
+        cards = {flashcard_id: to_fsrs_card(schedule) for flashcard_id, schedule in schedules.items()}
+    logs = []
+    for flashcard_id, rating in parsed_ratings:
+        with scheduler_service.timer("repeat"):
+            scheduling_info = fsrs.repeat(cards[flashcard_id], review_time)[rating]
+        cards[flashcard_id] = scheduling_info.card
+        logs.append(review_log_row(user_id, flashcard_id, scheduling_info.review_log))
+
+    updated = [
+        {"id": schedules[flashcard_id].id, "flashcard_id": flashcard_id, "user_id": user_id, **schedule_values(card)}
+        for flashcard_id, card in cards.items()
+    ]
+    db.bulk_update_mappings(models.CardSchedule, updated)
+    db.commit()
+    review_queues.reviewed(user_id, {schedule["flashcard_id"]: schedule["due"] for schedule in updated})
+    review_log_writer.log(logs)
+    return updated
+
+
+# Whole-deck reschedule endpoint
+'''
+Recomputes the interval and due date of every card in the user's schedule from its stability,
+vectorized over the whole deck, with the user's fitted FSRS weights (see optimizer.py) if there are any.
+'''
+@main_router.put("/cardschedule/reschedule")
+def reschedule_deck(db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
+    updated = reschedule_user(db, current_user['id'], scheduler_service.get(db, current_user['id']))
+    db.commit()
+    review_queues.invalidate(current_user['id'])
+    return {"message": "Schedule recomputed successfully", "updated": updated}
+
+
 # github attempt
 
 from fsrs import Card
 from datetime import datetime, timezone
-from zoneinfo import ZoneInfo
 
 @main_router.get("/cardschedule/{flashcard_id}", response_model=CardSchedule)
-async def get_cardschedule(flashcard_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    schedule = db.query(models.CardSchedule).filter_by(flashcard_id=flashcard_id, user_id=current_user['id']).first()
+async def get_cardschedule(flashcard_id: int, db: async_db_dependency, current_user: dict = Depends(get_current_user)):
+    schedule = (await execute(db, select(models.CardSchedule).filter_by(flashcard_id=flashcard_id, user_id=current_user['id']))).scalars().first()
     if not schedule:
         raise HTTPException(status_code=404, detail="CardSchedule not found")
     
-    card = Card(
-        due=schedule.due.replace(tzinfo=ZoneInfo("UTC")) if schedule.due.tzinfo is None else schedule.due,
-        stability=schedule.stability,
-        difficulty=schedule.difficulty,
-        elapsed_days=schedule.elapsed_days,
-        scheduled_days=schedule.scheduled_days,
-        reps=schedule.reps,
-        lapses=schedule.lapses,
-        state=schedule.state,
-        last_review=schedule.last_review.replace(tzinfo=ZoneInfo("UTC")) if schedule.last_review.tzinfo is None else schedule.last_review
-    )
+    card = to_fsrs_card(schedule)
     # Construct the response with required fields
     response = {
         "id": schedule.id,
@@ -394,44 +504,28 @@ async def get_cardschedule(flashcard_id: int, db: Session = Depends(get_db), cur
         "scheduled_days": card.scheduled_days,
         "reps": card.reps,
         "lapses": card.lapses,
-        "state": card.state,
-        "last_review": card.last_review
+        "state": card.state.name,
+        "last_review": getattr(card, "last_review", None)
     }
     return response
 
 
 @main_router.get("/cardschedule/{flashcard_id}", response_model=CardSchedule)
-async def get_Card_in_schedule(flashcard_id: int, db: Session = Depends(get_db), current_user: dict = Depends(get_current_user)):
-    schedule = db.query(models.CardSchedule).filter_by(flashcard_id=flashcard_id, user_id=current_user['id']).first()
+async def get_Card_in_schedule(flashcard_id: int, db: async_db_dependency, current_user: dict = Depends(get_current_user)):
+    schedule = (await execute(db, select(models.CardSchedule).filter_by(flashcard_id=flashcard_id, user_id=current_user['id']))).scalars().first()
     if not schedule:
         raise HTTPException(status_code=404, detail="CardSchedule not found")
     
-    card = Card(
-        due=schedule.due.replace(tzinfo=ZoneInfo("UTC")) if schedule.due.tzinfo is None else schedule.due,
-        stability=schedule.stability,
-        difficulty=schedule.difficulty,
-        elapsed_days=schedule.elapsed_days,
-        scheduled_days=schedule.scheduled_days,
-        reps=schedule.reps,
-        lapses=schedule.lapses,
-        state=schedule.state,
-        last_review=schedule.last_review.replace(tzinfo=ZoneInfo("UTC")) if schedule.last_review.tzinfo is None else schedule.last_review
-    )
+    card = to_fsrs_card(schedule)
     
     # Update the schedule with the card data
-    schedule.due = card.due
-    schedule.stability = card.stability
-    schedule.difficulty = card.difficulty
-    schedule.elapsed_days = card.elapsed_days
-    schedule.scheduled_days = card.scheduled_days
-    schedule.reps = card.reps
-    schedule.lapses = card.lapses
-    schedule.state = card.state
-    schedule.last_review = card.last_review
+    for name, value in schedule_values(card).items():
+        setattr(schedule, name, value)
     
     # Commit the changes to the database
-    db.commit()
-    db.refresh(schedule)
+    await commit(db)
+    await refresh(db, schedule)
+    review_queues.reviewed(current_user['id'], {schedule.flashcard_id: schedule.due})
     
     # Construct the response with required fields
     response = {
@@ -468,43 +562,22 @@ def easy_review(flashcard_id: int, db: Session = Depends(get_db), current_user:
 
     if not card_schedule:
         raise HTTPException(status_code=404, detail="Flashcard not found in user's schedule")
-    # Instantiate the Card object from CardSchedule
-    
+    # Review the card with a rating of Easy, with the user's cached scheduler
     try:
-        card = Card(
-            due=card_schedule.due.replace(tzinfo=timezone.utc),
-            stability=card_schedule.stability,
-            difficulty=card_schedule.difficulty,
-            elapsed_days=card_schedule.elapsed_days,
-            scheduled_days=card_schedule.scheduled_days,
-            reps=card_schedule.reps,
-            lapses=card_schedule.lapses,
-            state=card_schedule.state,
-            last_review=card_schedule.last_review.replace(tzinfo=timezone.utc)
-        )
-    except Exception as e:
+        scheduling_info = scheduler_service.review(db, current_user['id'], card_schedule, Rating.Easy)
+    except (KeyError, ValueError) as e:
         raise HTTPException(status_code=500, detail=f"Failed to instantiate Card object: {str(e)}")
-    # Review the card with a rating of Easy
-    fsrs = FSRS()
-    #reviewed_card, ReviewLog = fsrs.review_card(card, Rating.Easy)
-    
-    #
-    scheduling_cards = fsrs.repeat(card, datetime.now(timezone.utc))
-    reviewed_card = scheduling_cards[Rating.Easy].card
+    reviewed_card = scheduling_info.card
+    review_log = scheduling_info.review_log
     
     
     # Update the database with the reviewed card
-    card_schedule.due = reviewed_card.due.replace(tzinfo=None)
-    card_schedule.stability = reviewed_card.stability
-    card_schedule.difficulty = reviewed_card.difficulty
-    card_schedule.elapsed_days = reviewed_card.elapsed_days
-    card_schedule.scheduled_days = reviewed_card.scheduled_days
-    card_schedule.reps = reviewed_card.reps
-    card_schedule.lapses = reviewed_card.lapses
-    card_schedule.state = reviewed_card.state
-    card_schedule.last_review = datetime.now()
+    for name, value in schedule_values(reviewed_card).items():
+        setattr(card_schedule, name, value)
 
     db.commit()
     db.refresh(card_schedule)
+    review_queues.reviewed(current_user['id'], {flashcard_id: card_schedule.due})
+    review_log_writer.log([review_log_row(current_user['id'], flashcard_id, review_log)])
 
     return card_schedule
\ No newline at end of file
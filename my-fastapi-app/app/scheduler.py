@@ -0,0 +1,168 @@
+"""
+Conversions between CardSchedule rows and fsrs Cards, and the per-user FSRS schedulers.
+
+The database keeps naive UTC timestamps and the state as its name ("New", "Review", ...),
+while fsrs wants timezone-aware UTC datetimes and State/Rating enums.
+
+`scheduler_service` keeps the FSRS scheduler of recently active users (with their fitted
+weights, see optimizer.py) in an LRU cache, so a review only converts the row and runs
+FSRS.repeat. Entries are reloaded after `ttl` seconds to pick up weights fitted by another
+process. It times loading, converting and reviewing per call (GET /main/scheduler/stats).
+"""
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+from fsrs import FSRS, Card, Rating, State
+from sqlalchemy.orm import Session
+
+import models
+from cache import LRUCache
+
+
+SCHEDULE_FIELDS = ("due", "stability", "difficulty", "elapsed_days", "scheduled_days", "reps", "lapses", "state", "last_review")
+
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Returns `value` as an aware UTC datetime (naive values are taken to be UTC already)."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+# The spellings of states found in the table, looked up before parsing anything
+KNOWN_STATES = {}
+for _state in State:
+    KNOWN_STATES.update({_state: _state, _state.value: _state, str(_state.value): _state, _state.name: _state, _state.name.lower(): _state, str(_state): _state})
+
+
+def parse_state(value) -> State:
+    """Reads a stored state: a State, its number, or its name in any case ("new", "Review", "State.Review")."""
+    state = KNOWN_STATES.get(value)
+    if state is not None:
+        return state
+    text = str(value).strip()
+    if text.isdigit():
+        return State(int(text))
+    return State[text.split(".")[-1].capitalize()]
+
+
+def parse_rating(value) -> Rating:
+    """Reads a rating given by a client: its number ("3") or its name in any case ("good")."""
+    text = str(value).strip()
+    if text.isdigit():
+        return Rating(int(text))
+    return Rating[text.capitalize()]
+
+
+def user_scheduler(db: Session, user_id: int) -> FSRS:
+    """An FSRS scheduler with the user's fitted weights (see optimizer.py), or the default weights."""
+    weights = db.query(models.FSRSParams.weights).filter(models.FSRSParams.user_id == user_id).scalar()
+    return FSRS(w=tuple(weights)) if weights else FSRS()
+
+
+def to_fsrs_card(schedule) -> Card:
+    """Builds an fsrs Card from a CardSchedule row (or any object with the same attributes)."""
+    return Card(
+        due=as_utc(schedule.due),
+        stability=schedule.stability,
+        difficulty=schedule.difficulty,
+        elapsed_days=schedule.elapsed_days,
+        scheduled_days=schedule.scheduled_days,
+        reps=schedule.reps,
+        lapses=schedule.lapses,
+        state=parse_state(schedule.state),
+        last_review=as_utc(schedule.last_review),
+    )
+
+
+def schedule_values(card: Card) -> dict:
+    """The CardSchedule column values of an fsrs Card, with naive UTC timestamps."""
+    return {
+        "due": card.due.astimezone(timezone.utc).replace(tzinfo=None),
+        "stability": card.stability,
+        "difficulty": card.difficulty,
+        "elapsed_days": card.elapsed_days,
+        "scheduled_days": card.scheduled_days,
+        "reps": card.reps,
+        "lapses": card.lapses,
+        "state": card.state.name,
+        "last_review": card.last_review.astimezone(timezone.utc).replace(tzinfo=None) if card.last_review else None,
+    }
+
+
+class CallTimer:
+    """Counts the calls and the time spent in named sections of code."""
+
+    def __init__(self):
+        self._sections = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                calls, total, worst = self._sections.get(name, (0, 0.0, 0.0))
+                self._sections[name] = (calls + 1, total + elapsed, max(worst, elapsed))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {"calls": calls, "mean_us": total / calls * 1e6, "max_us": worst * 1e6}
+                for name, (calls, total, worst) in self._sections.items()
+            }
+
+
+class SchedulerService:
+    """Per-user FSRS schedulers, LRU bounded, plus the review path that uses them."""
+
+    def __init__(self, max_users: int = 10_000, ttl: float = 300.0):
+        self.schedulers = LRUCache(max_users)
+        self.ttl = ttl
+        self.timer = CallTimer()
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, user_id: int) -> FSRS:
+        """The user's scheduler, loaded from fsrs_params at most once every `ttl` seconds."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self.schedulers.get(user_id)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+        with self.timer("load"):
+            scheduler = user_scheduler(db, user_id)
+        with self._lock:
+            self.schedulers.put(user_id, (now, scheduler))
+        return scheduler
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Forgets the scheduler of a user (e.g. after fitting new weights), or of everyone."""
+        with self._lock:
+            if user_id is None:
+                self.schedulers.clear()
+            else:
+                self.schedulers.pop(user_id)
+
+    def review(self, db: Session, user_id: int, schedule, rating: Rating, now: Optional[datetime] = None):
+        """Reviews a CardSchedule row with the user's scheduler; returns the fsrs SchedulingInfo (card and review_log)."""
+        scheduler = self.get(db, user_id)
+        with self.timer("convert"):
+            card = to_fsrs_card(schedule)
+        with self.timer("repeat"):
+            return scheduler.repeat(card, now or datetime.now(timezone.utc))[rating]
+
+    def stats(self) -> dict:
+        with self._lock:
+            cache = self.schedulers.stats()
+        return {"schedulers": cache, "timings": self.timer.stats()}
+
+
+scheduler_service = SchedulerService()
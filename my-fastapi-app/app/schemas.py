@@ -2,7 +2,7 @@ from pydantic import BaseModel, EmailStr
 
 from enum import Enum
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Dict
 
 # Pydantic models for request and response handling
 class FlashcardType(str, Enum):
@@ -15,6 +15,7 @@ class FlashcardBase(BaseModel):
     level: int
     type: FlashcardType
     fields: str
+    field_values: Optional[Dict[str, str]] = None
 
     class Config:
         orm_mode = True
@@ -29,6 +30,14 @@ class UserBase(BaseModel):
     class Config:
         orm_mode = True
 
+class UserProfile(BaseModel):
+    id: int
+    username: str
+    email: str
+    created_at: Optional[datetime] = None
+    class Config:
+        orm_mode = True
+
 class CreateUserRequest(BaseModel):         
     username: str
     password: str